@@ -7,7 +7,8 @@
     :copyright: (c) 2013 by Openlabs Technologies & Consulting (P) Limited
     :license: BSD, see LICENSE for more details.
 """
-from blog import BlogPost, BlogPostComment
+from blog import BlogPost, BlogPostComment, BlogPostCommentQueue
+from spam import SpamToken
 
 from trytond.pool import Pool
 
@@ -19,5 +20,7 @@ def register():
     Pool.register(
         BlogPost,
         BlogPostComment,
+        BlogPostCommentQueue,
+        SpamToken,
         module='nereid_blog', type_='model'
     )
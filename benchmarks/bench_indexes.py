@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+    bench_indexes
+
+    Compare the query plans and timings of the hot blog.post lookups before
+    and after the composite indexes created by `BlogPost.__register__`.
+
+    The table is a stripped down copy of blog_post carrying the indexes
+    Tryton creates for the fields (select=True and the UNIQUE constraint).
+    Runs on an in memory sqlite database by default, pass a DSN to run it on
+    PostgreSQL (requires psycopg2)::
+
+        python benchmarks/bench_indexes.py --posts 1000000
+        python benchmarks/bench_indexes.py --dsn "dbname=bench" --posts 1000000
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+from __future__ import print_function
+
+import argparse
+import random
+import sqlite3
+import time
+from datetime import datetime, timedelta
+
+TABLE = '''
+CREATE TABLE blog_post (
+    id INTEGER PRIMARY KEY,
+    title VARCHAR,
+    uri VARCHAR,
+    nereid_user INTEGER,
+    post_date TIMESTAMP,
+    state VARCHAR,
+    content TEXT,
+    CONSTRAINT blog_post_nereid_user_uri_uniq UNIQUE (nereid_user, uri)
+)
+'''
+
+# Indexes created by Tryton for the select=True fields
+FIELD_INDEXES = [
+    'CREATE INDEX blog_post_title_index ON blog_post (title)',
+    'CREATE INDEX blog_post_uri_index ON blog_post (uri)',
+    'CREATE INDEX blog_post_nereid_user_index ON blog_post (nereid_user)',
+]
+
+# Kept in sync with BlogPost.__register__
+COMPOSITE_INDEXES = [
+    'CREATE INDEX blog_post_user_date_index '
+    'ON blog_post (nereid_user, post_date, id)',
+    'CREATE INDEX blog_post_published_user_date_index '
+    'ON blog_post (nereid_user, post_date, id) '
+    "WHERE state = 'Published'",
+    'CREATE INDEX blog_post_published_date_index '
+    'ON blog_post (post_date, id) '
+    "WHERE state = 'Published'",
+]
+
+QUERIES = [
+    (
+        'render / get_post_for_uri',
+        'SELECT id FROM blog_post WHERE nereid_user = %(user)s '
+        "AND uri = '%(uri)s'",
+    ),
+    (
+        'render_list',
+        'SELECT id FROM blog_post WHERE nereid_user = %(user)s '
+        "AND state = 'Published' "
+        'ORDER BY post_date DESC, id DESC LIMIT 10',
+    ),
+    (
+        'render_list (cursor)',
+        'SELECT id FROM blog_post WHERE nereid_user = %(user)s '
+        "AND state = 'Published' AND post_date < '%(date)s' "
+        'ORDER BY post_date DESC, id DESC LIMIT 10',
+    ),
+    (
+        'render_latest (cursor)',
+        "SELECT id FROM blog_post WHERE state = 'Published' "
+        "AND post_date < '%(date)s' "
+        'ORDER BY post_date DESC, id DESC LIMIT 10',
+    ),
+    (
+        'my_posts',
+        'SELECT id FROM blog_post WHERE nereid_user = %(user)s '
+        'ORDER BY post_date DESC, id DESC LIMIT 10',
+    ),
+]
+
+
+class SQLite(object):
+    placeholder = '?'
+
+    def __init__(self, path=':memory:'):
+        self.connection = sqlite3.connect(path)
+
+    def explain(self, query):
+        cursor = self.connection.cursor()
+        cursor.execute('EXPLAIN QUERY PLAN ' + query)
+        return '\n'.join(str(row[-1]) for row in cursor.fetchall())
+
+    def analyze(self):
+        self.connection.execute('ANALYZE')
+
+
+class PostgreSQL(object):
+    placeholder = '%s'
+
+    def __init__(self, dsn):
+        import psycopg2
+        self.connection = psycopg2.connect(dsn)
+
+    def explain(self, query):
+        cursor = self.connection.cursor()
+        cursor.execute('EXPLAIN ANALYZE ' + query)
+        return '\n'.join(row[0] for row in cursor.fetchall())
+
+    def analyze(self):
+        self.connection.cursor().execute('ANALYZE blog_post')
+
+
+def populate(db, posts, users):
+    "Create the table and fill it with posts spread over users"
+    cursor = db.connection.cursor()
+    cursor.execute('DROP TABLE IF EXISTS blog_post')
+    cursor.execute(TABLE)
+    for index in FIELD_INDEXES:
+        cursor.execute(index)
+
+    start = datetime(2010, 1, 1)
+    states = ['Published'] * 8 + ['Draft', 'Archived']
+    query = 'INSERT INTO blog_post VALUES (%s)' % ', '.join(
+        [db.placeholder] * 7
+    )
+    batch = []
+    for post_id in range(1, posts + 1):
+        state = random.choice(states)
+        batch.append((
+            post_id, 'Post %d' % post_id, 'post-%d' % post_id,
+            random.randint(1, users),
+            start + timedelta(minutes=post_id) if state != 'Draft' else None,
+            state, 'Some content',
+        ))
+        if len(batch) == 10000:
+            cursor.executemany(query, batch)
+            batch = []
+    if batch:
+        cursor.executemany(query, batch)
+    db.connection.commit()
+    db.analyze()
+
+
+def run_queries(db, params, repeat):
+    "Return the plan and mean time in ms of every query"
+    cursor = db.connection.cursor()
+    results = []
+    for name, query in QUERIES:
+        query = query % params
+        begin = time.time()
+        for _ in range(repeat):
+            cursor.execute(query)
+            cursor.fetchall()
+        results.append(
+            (name, db.explain(query), (time.time() - begin) * 1000 / repeat)
+        )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--posts', type=int, default=1000000)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--dsn', help='PostgreSQL DSN, sqlite if missing')
+    options = parser.parse_args()
+
+    random.seed(0)
+    db = PostgreSQL(options.dsn) if options.dsn else SQLite()
+    print('Creating %d posts for %d users...' % (options.posts, options.users))
+    populate(db, options.posts, options.users)
+
+    params = {
+        'user': options.users // 2,
+        'uri': 'post-%d' % (options.posts // 2),
+        'date': datetime(2010, 1, 1) + timedelta(minutes=options.posts // 2),
+    }
+    before = run_queries(db, params, options.repeat)
+
+    cursor = db.connection.cursor()
+    for index in COMPOSITE_INDEXES:
+        cursor.execute(index)
+    db.connection.commit()
+    db.analyze()
+    after = run_queries(db, params, options.repeat)
+
+    for (name, plan_before, ms_before), (_, plan_after, ms_after) in zip(
+            before, after):
+        print('=' * 72)
+        print('%s: %.3f ms -> %.3f ms' % (name, ms_before, ms_after))
+        print('-- before')
+        print(plan_before)
+        print('-- after')
+        print(plan_after)
+
+
+if __name__ == '__main__':
+    main()
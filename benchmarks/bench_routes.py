@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""
+    bench_routes
+
+    Drive the blog routes through the Nereid test client against a seeded
+    database and report the latency percentiles and query counts of every
+    route as JSON.
+
+    Uses the trytond test database (DB_NAME, sqlite in memory by default)::
+
+        python benchmarks/bench_routes.py --users 10 --posts 100 \\
+            --comments 20 --requests 200 > routes.json
+
+    Unverified: this benchmark has not been run yet, no results are
+    recorded for it.
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+from __future__ import print_function
+
+import argparse
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+import simplejson as json
+from trytond.tests.test_tryton import (
+    POOL, USER, DB_NAME, CONTEXT, install_module
+)
+from trytond.transaction import Transaction
+from nereid.testing import NereidTestCase
+
+from common import QueryCounter, percentile
+
+XHR = [('X-Requested-With', 'XMLHttpRequest')]
+
+
+class RouteBenchmark(NereidTestCase):
+    "Seeds the database and times the routes"
+
+    templates = {
+        'localhost/blog_post_form.jinja': '{{ form.errors }}',
+        'localhost/blog_post.jinja': '{{ post.title }} {{ post.content }}',
+        'localhost/blog_posts.jinja': '{% for post in posts %}'
+            '{{ post.title }}{% endfor %}',
+        'localhost/my_blog_posts.jinja': '{% for post in posts %}'
+            '{{ post.title }}{% endfor %}',
+        'localhost/blog_post_edit.jinja': '{{ form.errors }}',
+    }
+
+    def runTest(self):
+        pass
+
+    def get_template_source(self, name):
+        return self.templates.get(name)
+
+    def seed(self, users, posts, comments):
+        "Create the website, users and their posts and comments"
+        Currency = POOL.get('currency.currency')
+        Company = POOL.get('company.company')
+        Party = POOL.get('party.party')
+        NereidUser = POOL.get('nereid.user')
+        Website = POOL.get('nereid.website')
+        Locale = POOL.get('nereid.website.locale')
+        Language = POOL.get('ir.lang')
+        UrlMap = POOL.get('nereid.url_map')
+        BlogPost = POOL.get('blog.post')
+
+        currency, = Currency.create([{
+            'name': 'US Dollar', 'code': 'USD', 'symbol': '$',
+        }])
+        party, = Party.create([{'name': 'openlabs'}])
+        company, = Company.create([{'party': party, 'currency': currency}])
+        guest_user, = NereidUser.create([{
+            'party': party, 'display_name': 'Guest User',
+            'email': 'guest@example.com', 'company': company,
+        }])
+        en_us, = Language.search([('code', '=', 'en_US')])
+        locale, = Locale.create([{
+            'code': 'en_US', 'language': en_us, 'currency': currency,
+        }])
+        url_map, = UrlMap.search([], limit=1)
+        Website.create([{
+            'name': 'localhost', 'url_map': url_map, 'company': company,
+            'application_user': USER, 'default_locale': locale,
+            'guest_user': guest_user, 'currencies': [('set', [currency])],
+        }])
+
+        self.users = NereidUser.create([{
+            'party': party,
+            'display_name': 'User %d' % i,
+            'email': 'user%d@example.com' % i,
+            'password': 'password',
+            'company': company,
+        } for i in range(users)])
+
+        self.posts = []
+        for user in self.users:
+            self.posts.extend(BlogPost.create([{
+                'title': 'Post %d' % i,
+                'uri': 'post-%d' % i,
+                'content': 'Some test content ' * 50,
+                'nereid_user': user.id,
+                'allow_guest_comments': True,
+                'state': 'Published',
+                'post_date': datetime(2014, 1, 1) + timedelta(hours=i),
+                'comments': [('create', [{
+                    'name': 'Commenter %d' % j,
+                    'content': 'This is an awesome post',
+                    'is_spam': j % 10 == 0,
+                } for j in range(comments)])],
+            } for i in range(posts)]))
+
+    def run_benchmark(self, requests):
+        "Return the statistics of every route"
+        app = self.get_app()
+        author = self.users[0]
+        own_posts = [p for p in self.posts if p.nereid_user == author]
+        draft = own_posts[-1]
+
+        def random_post():
+            return random.choice(self.posts)
+
+        def render(c, i):
+            post = random_post()
+            return c.get('/post/%d/%s' % (post.nereid_user.id, post.uri))
+
+        routes = [
+            ('render', False, render),
+            ('render_list', False, lambda c, i: c.get('/posts/%d' % (
+                random.choice(self.users).id
+            ), headers=XHR)),
+            ('render_comments GET', False, lambda c, i: c.get(
+                '/post/%d/-comment' % random_post().id
+            )),
+            ('render_comments POST', True, lambda c, i: c.post(
+                '/post/%d/-comment' % random.choice(own_posts).id, data={
+                    'name': 'Bench', 'content': 'Comment %d' % i,
+                }, headers=XHR
+            )),
+            ('my_posts', True, lambda c, i: c.get(
+                '/posts/-my', headers=XHR
+            )),
+            ('new_post', True, lambda c, i: c.post('/post/-new', data={
+                'title': 'Benchmark post %d' % i,
+                'content': 'Some test content',
+            }, headers=XHR)),
+            ('change_state', True, lambda c, i: c.post(
+                '/post/%d/-change-state' % draft.id, data={
+                    'state': 'draft' if i % 2 == 0 else 'publish',
+                }, headers=XHR
+            )),
+        ]
+
+        results = {}
+        for name, login, call in routes:
+            with app.test_client() as c:
+                if login:
+                    c.post('/login', data={
+                        'email': author.email, 'password': 'password',
+                    })
+                timings, queries, errors = [], [], 0
+                for i in range(requests):
+                    with QueryCounter() as counter:
+                        begin = time.time()
+                        rv = call(c, i)
+                        timings.append((time.time() - begin) * 1000)
+                    queries.append(counter.count)
+                    if rv.status_code >= 400:
+                        errors += 1
+            timings.sort()
+            results[name] = {
+                'requests': requests,
+                'errors': errors,
+                'p50_ms': percentile(timings, 50),
+                'p95_ms': percentile(timings, 95),
+                'p99_ms': percentile(timings, 99),
+                'queries_mean': float(sum(queries)) / len(queries),
+                'queries_max': max(queries),
+            }
+        return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument(
+        '--posts', type=int, default=100, help='posts per user')
+    parser.add_argument(
+        '--comments', type=int, default=20, help='comments per post')
+    parser.add_argument(
+        '--requests', type=int, default=200, help='requests per route')
+    options = parser.parse_args()
+
+    random.seed(0)
+    install_module('nereid_blog')
+    benchmark = RouteBenchmark()
+    with Transaction().start(DB_NAME, USER, CONTEXT):
+        benchmark.seed(options.users, options.posts, options.comments)
+        results = benchmark.run_benchmark(options.requests)
+        Transaction().cursor.rollback()
+
+    json.dump({
+        'options': vars(options),
+        'routes': results,
+    }, sys.stdout, indent=2, sort_keys=True)
+    print()
+
+
+if __name__ == '__main__':
+    main()
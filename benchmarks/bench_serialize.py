@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+    bench_serialize
+
+    Compare serializing posts and comments one record at a time with
+    `serialize` against `serialize_many` for 1, 100 and 10k records.
+
+    Uses the trytond test database (DB_NAME, sqlite in memory by default)::
+
+        python benchmarks/bench_serialize.py
+
+    Unverified: this benchmark has not been run yet, no results are
+    recorded for it.
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+from __future__ import print_function
+
+import time
+
+from trytond.tests.test_tryton import (
+    POOL, USER, DB_NAME, CONTEXT, install_module
+)
+from trytond.transaction import Transaction
+
+from common import QueryCounter
+
+SIZES = (1, 100, 10000)
+
+
+def create_records(count):
+    "Create count posts with a comment each and return their ids"
+    Currency = POOL.get('currency.currency')
+    Company = POOL.get('company.company')
+    Party = POOL.get('party.party')
+    NereidUser = POOL.get('nereid.user')
+    BlogPost = POOL.get('blog.post')
+    Comment = POOL.get('blog.post.comment')
+
+    currency, = Currency.create([{
+        'name': 'US Dollar', 'code': 'USD', 'symbol': '$',
+    }])
+    party, = Party.create([{'name': 'openlabs'}])
+    company, = Company.create([{'party': party, 'currency': currency}])
+    user, = NereidUser.create([{
+        'party': party, 'display_name': 'Author', 'email': 'a@example.com',
+        'company': company,
+    }])
+
+    post_ids = []
+    for start in range(0, count, 1000):
+        posts = BlogPost.create([{
+            'title': 'Post %d' % i,
+            'uri': 'post-%d' % i,
+            'content': 'Some test content ' * 20,
+            'nereid_user': user.id,
+        } for i in range(start, min(start + 1000, count))])
+        Comment.create([{
+            'post': post.id,
+            'name': 'John Doe',
+            'content': 'This is an awesome post',
+        } for post in posts])
+        post_ids.extend(p.id for p in posts)
+    comment_ids = [c.id for c in Comment.search([])]
+    return post_ids, comment_ids
+
+
+def measure(Model, ids, bulk, repeat):
+    "Return mean time in ms and queries of serializing ids"
+    elapsed, queries = 0, 0
+    for _ in range(repeat):
+        # Fresh instances, as every request would get
+        records = Model.browse(ids)
+        with QueryCounter() as counter:
+            begin = time.time()
+            if bulk:
+                Model.serialize_many(records)
+            else:
+                [record.serialize() for record in records]
+            elapsed += time.time() - begin
+        queries += counter.count
+    return elapsed * 1000 / repeat, queries // repeat
+
+
+def main():
+    install_module('nereid_blog')
+    with Transaction().start(DB_NAME, USER, CONTEXT):
+        post_ids, comment_ids = create_records(max(SIZES))
+        print('%-18s %7s %22s %22s' % (
+            'model', 'records', 'serialize ms (queries)',
+            'serialize_many ms (queries)'
+        ))
+        for model, ids in (
+                ('blog.post', post_ids), ('blog.post.comment', comment_ids)):
+            Model = POOL.get(model)
+            for size in SIZES:
+                repeat = max(1, 1000 // size)
+                single = measure(Model, ids[:size], False, repeat)
+                bulk = measure(Model, ids[:size], True, repeat)
+                print('%-18s %7d %15.2f (%4d) %15.2f (%4d)' % (
+                    (model, size) + single + bulk
+                ))
+        Transaction().cursor.rollback()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+"""
+    common
+
+    Helpers shared by the benchmarks
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+from trytond.modules.nereid_blog.instrumentation import QueryCounter
+
+__all__ = ['QueryCounter', 'percentile']
+
+
+def percentile(values, percent):
+    "Return the nearest rank percentile of the sorted values"
+    if not values:
+        return None
+    rank = int(round(percent / 100.0 * len(values) + 0.5)) - 1
+    return values[max(0, min(rank, len(values) - 1))]
@@ -7,29 +7,144 @@
     :copyright: (c) 2013-2014 by Openlabs Technologies & Consulting (P) Limited
     :license: BSD, see LICENSE for more details.
 """
+import hashlib
+import math
+import re
 import warnings
+import simplejson as json
+from base64 import urlsafe_b64encode, urlsafe_b64decode
 from datetime import datetime
 
 from wtforms import Form, TextField, TextAreaField, BooleanField, validators
 from wtforms.validators import ValidationError
+from flask import current_app
 from flask_wtf import RecaptchaField
+from werkzeug.contrib.atom import AtomFeed
+from markupsafe import Markup, escape
+from sql.aggregate import Count, Max
+from sql.conditionals import Coalesce
+from trytond import backend
 from trytond.model import ModelSQL, ModelView, Workflow, fields
 from trytond.pyson import Bool, Eval
 from trytond.pool import Pool, PoolMeta
+from trytond.rpc import RPC
 from trytond.config import CONFIG
 from trytond.transaction import Transaction
 
 from nereid import (
-    request, abort, render_template, login_required, url_for, redirect, flash,
-    jsonify, current_user, route
+    request, abort, login_required, url_for, redirect, flash, jsonify,
+    current_user, route, session
 )
 from nereid.contrib.pagination import Pagination
 from nereid.helpers import slugify
 
-__all__ = ['BlogPost', 'BlogPostComment']
+from cache import render_cache, uri_cache, feed_cache, list_cache
+import invalidation
+from search import (
+    register_search_index, index_posts, unindex_posts, search_posts,
+    search_available
+)
+from instrumentation import (
+    instrumented, timing, render_template, make_response, route_stats,
+    is_enabled
+)
+from ratelimit import rate_limited, stats as rate_limit_stats
+import spam
+
+__all__ = ['BlogPost', 'BlogPostComment', 'BlogPostCommentQueue']
 __classmeta__ = PoolMeta
 
 STATES = {'readonly': Eval('state') != 'Draft'}
+#: States reached by the transition methods of the posts
+TRANSITION_STATES = {
+    'draft': 'Draft',
+    'publish': 'Published',
+    'archive': 'Archived',
+}
+#: Fields of the posts shown in the feeds
+FEED_FIELDS = set(['state', 'title', 'uri', 'content', 'post_date'])
+CURSOR_DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def encode_cursor(post_date, post_id):
+    """
+    Return an opaque cursor pointing after the post with the given
+    post_date and id
+    """
+    value = '%s|%d' % (
+        post_date.strftime(CURSOR_DATE_FORMAT) if post_date else '', post_id
+    )
+    return urlsafe_b64encode(value)
+
+
+def decode_cursor(cursor):
+    """
+    Return the (post_date, id) tuple encoded in cursor. Aborts with a 400
+    if the cursor is not a valid one.
+    """
+    try:
+        post_date, post_id = urlsafe_b64decode(str(cursor)).split('|')
+        return (
+            datetime.strptime(post_date, CURSOR_DATE_FORMAT)
+            if post_date else None,
+            int(post_id)
+        )
+    except (TypeError, ValueError):
+        abort(400)
+
+
+def comment_queue_enabled():
+    """
+    Return True if the comments posted are queued rather than inserted
+    right away, see :class:`BlogPostCommentQueue`
+    """
+    return str(CONFIG.options.get('blog_comment_queue', '')).lower() in (
+        '1', 'true', 'yes', 'on'
+    )
+
+
+def make_etag(*parts):
+    "Return an entity tag for a response built from the given parts"
+    return hashlib.md5(repr(parts)).hexdigest()
+
+
+def not_modified(etag, last_modified=None):
+    """
+    Return a 304 response if the client already has the representation
+    with the etag, or one not older than last_modified, else None.
+
+    If-None-Match takes precedence over If-Modified-Since, which is only
+    looked at when the client sent no entity tag. Requests with pending
+    flash messages are never answered with a 304 as the page would have
+    displayed them.
+    """
+    if request.method not in ('GET', 'HEAD') or session.get('_flashes'):
+        return None
+    if request.if_none_match:
+        matched = request.if_none_match.contains_weak(etag)
+    elif last_modified is not None and request.if_modified_since:
+        matched = request.if_modified_since.replace(tzinfo=None) >= \
+            last_modified.replace(microsecond=0)
+    else:
+        matched = False
+    if not matched:
+        return None
+    return add_validators(
+        current_app.response_class(status=304), etag, last_modified
+    )
+
+
+def add_validators(rv, etag, last_modified=None):
+    """
+    Return the response for rv with the ETag and Last-Modified headers,
+    which are only set on successful responses
+    """
+    rv = make_response(rv)
+    if rv.status_code in (200, 304) and not session.get('_flashes'):
+        rv.set_etag(etag, weak=True)
+        if last_modified is not None:
+            rv.last_modified = last_modified
+    return rv
 
 
 class BlogPostForm(Form):
@@ -42,19 +157,29 @@ class BlogPostForm(Form):
     allow_guest_comments = BooleanField('Allow Guest Comments ?', default=True)
 
     def validate_uri(self, field):
+        """
+        URIs are unique per user. A URI derived from the title is made
+        unique with a numeric suffix while a URI given explicitly must be
+        free.
+        """
         BlogPost = Pool().get('blog.post')
 
         if not field.data and not self.data['title']:
             return
+        explicit = bool(field.data)
         field.process_data(slugify(field.data or self.data['title']))
-        domain = [('uri', '=', field.data)]
-        if Transaction().context.get('blog_id'):
-            # blog_id in context means editing form
-            domain.append(('id', '!=', Transaction().context['blog_id']))
-        if BlogPost.search(domain):
+        # blog_id in context means editing form
+        exclude_id = Transaction().context.get('blog_id')
+        user_id = request.nereid_user.id
+        if not BlogPost.uri_exists(user_id, field.data, exclude_id):
+            return
+        if explicit:
             raise ValidationError(
                 'Blog with the same URL exists. Please change title or modify'
             )
+        field.process_data(
+            BlogPost.get_free_uri(user_id, field.data, exclude_id)
+        )
 
 
 class PostCommentForm(Form):
@@ -88,7 +213,18 @@ class BlogPost(Workflow, ModelSQL, ModelView):
         states=STATES
     )
     post_date = fields.DateTime('Post Date', states=STATES)
-    content = fields.Text('Content', states=STATES)
+    scheduled_publish_date = fields.DateTime(
+        'Scheduled Publish Date', states=STATES,
+        help='The draft is published by the scheduler once this date is '
+        'past',
+    )
+    content = fields.Text('Content', states=STATES, loading='lazy')
+    content_html = fields.Text('Content HTML', readonly=True, loading='lazy')
+    excerpt = fields.Text('Excerpt', readonly=True)
+    word_count = fields.Integer('Word Count', readonly=True)
+    reading_time = fields.Integer(
+        'Reading Time', readonly=True, help='Estimated in minutes'
+    )
     allow_guest_comments = fields.Boolean(
         'Allow Guest Comments ?', select=True
     )
@@ -100,6 +236,11 @@ class BlogPost(Workflow, ModelSQL, ModelView):
             'blog.post.comment', None, 'Published Comments'
         ), 'get_published_comments'
     )
+    comment_count = fields.Integer('Comment Count', readonly=True)
+    published_comment_count = fields.Integer(
+        'Published Comment Count', readonly=True,
+        help='The comments which are not spam'
+    )
     state = fields.Selection([
         ('Draft', 'Draft'),
         ('Published', 'Published'),
@@ -110,14 +251,97 @@ class BlogPost(Workflow, ModelSQL, ModelView):
     def default_state():
         return 'Draft'
 
-    def get_published_comments(self, name):
-        "Returns the published comments, i.e., comments not marked as spam"
+    @staticmethod
+    def default_comment_count():
+        return 0
+
+    @staticmethod
+    def default_published_comment_count():
+        return 0
+
+    @classmethod
+    def get_published_comments(cls, posts, name):
+        """
+        Returns the published comments, i.e., comments not marked as spam,
+        for all the posts with a single query.
+        """
         Comment = Pool().get('blog.post.comment')
+        comment = Comment.__table__()
+        cursor = Transaction().cursor
+
+        post_ids = [p.id for p in posts]
+        comments = dict((post_id, []) for post_id in post_ids)
+        for i in range(0, len(post_ids), cursor.IN_MAX):
+            sub_ids = post_ids[i:i + cursor.IN_MAX]
+            cursor.execute(*comment.select(
+                comment.post, comment.id,
+                where=comment.post.in_(sub_ids) & ~comment.is_spam,
+                order_by=[comment.post, comment.id],
+            ))
+            for post_id, comment_id in cursor.fetchall():
+                comments[post_id].append(comment_id)
+        return comments
+
+    @classmethod
+    def update_comment_counts(cls, deltas):
+        """
+        Add to the comment counters of the posts.
 
-        return map(int, Comment.search([
-            ('post', '=', self.id),
-            ('is_spam', '=', False)
-        ]))
+        The counters are incremented in the database rather than written
+        from values computed in python, so that concurrent comments on the
+        same post are all counted.
+
+        :param deltas: dictionary of post id to a (comment_count,
+                       published_comment_count) tuple of increments
+        """
+        table = cls.__table__()
+        cursor = Transaction().cursor
+
+        post_ids = []
+        for post_id, (total, published) in deltas.iteritems():
+            if not (total or published):
+                continue
+            cursor.execute(*table.update(
+                [table.comment_count, table.published_comment_count], [
+                    table.comment_count + total,
+                    table.published_comment_count + published,
+                ],
+                where=table.id == post_id
+            ))
+            post_ids.append(post_id)
+        if post_ids:
+            # Clear the values cached for the posts and mark them modified
+            cls.write(cls.browse(post_ids), {})
+
+    @classmethod
+    def recompute_comment_counts(cls, posts=None):
+        """
+        Recompute the comment counters of the posts (all of them by
+        default) from their comments, with one query per chunk of posts.
+        """
+        Comment = Pool().get('blog.post.comment')
+        cursor = Transaction().cursor
+
+        query = (
+            'UPDATE "%(post)s" SET '
+            '"comment_count" = (SELECT COUNT(*) FROM "%(comment)s" '
+                'WHERE "%(comment)s"."post" = "%(post)s"."id"), '
+            '"published_comment_count" = (SELECT COUNT(*) FROM "%(comment)s" '
+                'WHERE "%(comment)s"."post" = "%(post)s"."id" '
+                'AND NOT "%(comment)s"."is_spam")'
+        ) % {'post': cls._table, 'comment': Comment._table}
+
+        if posts is None:
+            cursor.execute(query)
+            return
+        post_ids = map(int, posts)
+        for i in range(0, len(post_ids), cursor.IN_MAX):
+            sub_ids = post_ids[i:i + cursor.IN_MAX]
+            cursor.execute(query + ' WHERE "id" IN (%s)' % ', '.join(
+                str(post_id) for post_id in sub_ids
+            ))
+        if post_ids:
+            cls.write(cls.browse(post_ids), {})
 
     @classmethod
     def __setup__(cls):
@@ -146,7 +370,113 @@ class BlogPost(Workflow, ModelSQL, ModelView):
                 'invisible': Eval('state') != 'Published',
             }
         })
+        cls.__rpc__.update({
+            'rerender_content_html': RPC(readonly=False),
+            'bulk_change_state': RPC(readonly=False),
+        })
         cls.per_page = 10
+        cls.excerpt_length = 200
+        cls.words_per_minute = 200
+        cls.comments_max_limit = 1000
+        cls.feed_size = 20
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        Comment = Pool().get('blog.post.comment')
+        cursor = Transaction().cursor
+        table = TableHandler(cursor, cls, module_name)
+
+        # Migration: excerpt, word_count and reading_time are new
+        fill_excerpts = not table.column_exist('excerpt')
+        # Migration: comment counters are new. On a new install the table
+        # of the comments, registered after this one, does not exist yet
+        # and there is nothing to count.
+        fill_comment_counts = not table.column_exist('comment_count') and \
+            TableHandler.table_exist(cursor, Comment._table)
+        # Migration: content_html is new
+        fill_content_html = not table.column_exist('content_html')
+
+        super(BlogPost, cls).__register__(module_name)
+
+        if fill_comment_counts:
+            cls.recompute_comment_counts()
+        if fill_content_html:
+            cls.rerender_content_html()
+
+        if fill_excerpts:
+            sql_table = cls.__table__()
+            cursor.execute(*sql_table.select(sql_table.id, sql_table.content))
+            for post_id, content in cursor.fetchall():
+                values = cls.get_excerpt_values(content)
+                cursor.execute(*sql_table.update(
+                    [sql_table.excerpt, sql_table.word_count,
+                        sql_table.reading_time],
+                    [values['excerpt'], values['word_count'],
+                        values['reading_time']],
+                    where=sql_table.id == post_id
+                ))
+
+        register_search_index(cls._table)
+
+        # The UNIQUE(nereid_user, uri) constraint already provides the
+        # composite index used to look a post up by its uri. These back the
+        # listings of a user, which filter on the user and walk post_date.
+        cls._create_index(
+            'blog_post_user_date_index', ['nereid_user', 'post_date', 'id']
+        )
+        cls._create_index(
+            'blog_post_published_user_date_index',
+            ['nereid_user', 'post_date', 'id'], "state = 'Published'"
+        )
+        # The timeline of all the users walks the published posts by date
+        cls._create_index(
+            'blog_post_published_date_index', ['post_date', 'id'],
+            "state = 'Published'"
+        )
+        # Only the scheduled drafts are indexed, for the scheduler
+        cls._create_index(
+            'blog_post_scheduled_index', ['scheduled_publish_date', 'id'],
+            "state = 'Draft' AND scheduled_publish_date IS NOT NULL"
+        )
+
+    @classmethod
+    def _create_index(cls, name, columns, where=None):
+        """
+        Create the index name on columns of the table if it does not exist.
+        A where clause makes it a partial index, which is only created on
+        the backends supporting them: PostgreSQL and sqlite from 3.8.0.
+        """
+        cursor = Transaction().cursor
+        db_type = CONFIG['db_type']
+
+        if db_type == 'postgresql':
+            cursor.execute(
+                'SELECT 1 FROM pg_indexes WHERE indexname = %s', (name,)
+            )
+        elif db_type == 'sqlite':
+            if where:
+                cursor.execute('SELECT sqlite_version()')
+                version = tuple(
+                    int(part) for part in cursor.fetchone()[0].split('.')[:3]
+                )
+                if version < (3, 8, 0):
+                    return
+            cursor.execute(
+                'SELECT 1 FROM sqlite_master '
+                'WHERE type = \'index\' AND name = ?', (name,)
+            )
+        else:
+            return
+        if cursor.fetchone():
+            return
+
+        query = 'CREATE INDEX "%s" ON "%s" (%s)' % (
+            name, cls._table, ', '.join('"%s"' % c for c in columns)
+        )
+        if where:
+            query += ' WHERE ' + where
+        cursor.execute(query)
 
     @classmethod
     @ModelView.button
@@ -158,7 +488,96 @@ class BlogPost(Workflow, ModelSQL, ModelView):
     @ModelView.button
     @Workflow.transition('Published')
     def publish(cls, posts):
-        cls.write(posts, {'post_date': datetime.utcnow()})
+        # The scheduler and the bulk changes give the date of publication in
+        # blog_publish_date. A post published by hand is not scheduled
+        # anymore.
+        post_date = Transaction().context.get('blog_publish_date')
+        cls.write(posts, {
+            'post_date': post_date or datetime.utcnow(),
+            'scheduled_publish_date': None,
+        })
+
+    @classmethod
+    def publish_scheduled(cls, batch_size=500):
+        """
+        Publish the drafts whose scheduled publish date is past, batch_size
+        posts at a time. Meant to be run by the cron.
+
+        Due drafts are found through the partial index on the scheduled
+        drafts, so the cost does not depend on the number of posts.
+        """
+        table = cls.__table__()
+        cursor = Transaction().cursor
+        now = datetime.utcnow()
+        due = table.scheduled_publish_date <= now
+
+        while True:
+            cursor.execute(*table.select(
+                table.id, where=(table.state == 'Draft') & due,
+                order_by=[table.scheduled_publish_date, table.id],
+                limit=batch_size
+            ))
+            post_ids = [row[0] for row in cursor.fetchall()]
+            if not post_ids:
+                break
+            with Transaction().set_context(blog_publish_date=now):
+                cls.publish(cls.browse(post_ids))
+            if len(post_ids) < batch_size:
+                break
+
+    @classmethod
+    def bulk_change_state(
+            cls, post_ids, state, nereid_user=None, chunk_size=500):
+        """
+        Apply the transition state (draft, publish or archive) to the posts
+        and return the result for every id as a list of dictionaries with
+        the id, success, state and error (not_found or invalid_transition)
+        keys.
+
+        The posts and their current state are fetched with one query, so
+        are the posts of nereid_user only when one is given. The transition
+        is then applied chunk_size posts at a time, and all the posts
+        published get the same post date.
+        """
+        if state not in TRANSITION_STATES:
+            raise ValueError('Invalid state: %s' % state)
+        target = TRANSITION_STATES[state]
+        table = cls.__table__()
+        cursor = Transaction().cursor
+
+        post_ids = map(int, post_ids)
+        states = {}
+        for i in range(0, len(post_ids), cursor.IN_MAX):
+            where = table.id.in_(post_ids[i:i + cursor.IN_MAX])
+            if nereid_user is not None:
+                where &= table.nereid_user == int(nereid_user)
+            cursor.execute(*table.select(table.id, table.state, where=where))
+            states.update(cursor.fetchall())
+
+        to_change = [
+            post_id for post_id in sorted(states)
+            if (states[post_id], target) in cls._transitions
+        ]
+        with Transaction().set_context(blog_publish_date=datetime.utcnow()):
+            for i in range(0, len(to_change), chunk_size):
+                getattr(cls, state)(cls.browse(to_change[i:i + chunk_size]))
+
+        to_change = set(to_change)
+        results = []
+        for post_id in post_ids:
+            if post_id in to_change:
+                results.append({
+                    'id': post_id, 'success': True, 'state': target,
+                    'error': None,
+                })
+            else:
+                results.append({
+                    'id': post_id, 'success': False,
+                    'state': states.get(post_id),
+                    'error': 'invalid_transition' if post_id in states
+                        else 'not_found',
+                })
+        return results
 
     @classmethod
     @ModelView.button
@@ -166,6 +585,448 @@ class BlogPost(Workflow, ModelSQL, ModelView):
     def archive(cls, posts):
         pass
 
+    @classmethod
+    def get_excerpt_values(cls, content):
+        """
+        Return the values of the fields derived from content: the excerpt
+        shown in listings, the word count and the reading time.
+        """
+        content = content or ''
+        words = len(content.split())
+        if len(content) <= cls.excerpt_length:
+            excerpt = content
+        else:
+            excerpt = content[:cls.excerpt_length]
+            if not content[cls.excerpt_length].isspace():
+                # Do not cut the last word, unless it is the only one
+                parts = excerpt.rsplit(None, 1)
+                if len(parts) > 1:
+                    excerpt = parts[0]
+            excerpt = excerpt.rstrip() + '...'
+        return {
+            'excerpt': excerpt,
+            'word_count': words,
+            'reading_time': int(math.ceil(
+                float(words) / cls.words_per_minute
+            )),
+        }
+
+    @staticmethod
+    def render_content(content):
+        """
+        Return the sanitized HTML for content: the blocks separated by
+        blank lines become paragraphs and the line breaks are kept. Raw
+        HTML in the content is escaped.
+
+        The rendering does not depend on any optional package so that every
+        worker stores the same markup for the same content.
+        """
+        if not content:
+            return ''
+        paragraphs = re.split(r'\n\s*\n', content.strip())
+        return u'\n'.join(
+            u'<p>%s</p>' % escape(paragraph).replace('\n', Markup('<br>\n'))
+            for paragraph in paragraphs
+        )
+
+    @classmethod
+    def rerender_content_html(cls, posts=None, chunk_size=500):
+        """
+        Render again the HTML of the content of the posts, all of them by
+        default, for example after the renderer has been upgraded.
+
+        The posts are processed chunk_size at a time and updated in place,
+        then the cached pages are dropped.
+        """
+        table = cls.__table__()
+        cursor = Transaction().cursor
+
+        def render(where):
+            cursor.execute(*table.select(
+                table.id, table.content, where=where, order_by=table.id,
+                limit=chunk_size
+            ))
+            rows = cursor.fetchall()
+            for post_id, content in rows:
+                cursor.execute(*table.update(
+                    [table.content_html], [cls.render_content(content)],
+                    where=table.id == post_id
+                ))
+            return rows
+
+        if posts is None:
+            last_id = 0
+            while True:
+                rows = render(table.id > last_id)
+                if len(rows) < chunk_size:
+                    break
+                last_id = rows[-1][0]
+        else:
+            post_ids = map(int, posts)
+            for i in range(0, len(post_ids), chunk_size):
+                render(table.id.in_(post_ids[i:i + chunk_size]))
+        invalidation.clear()
+
+    @classmethod
+    def _content_values(cls, values):
+        "Return values completed with the fields derived from content"
+        if 'content' in values:
+            values = values.copy()
+            values.update(cls.get_excerpt_values(values['content']))
+            values['content_html'] = cls.render_content(values['content'])
+        return values
+
+    @classmethod
+    def create(cls, vlist):
+        posts = super(BlogPost, cls).create(
+            [cls._content_values(values) for values in vlist]
+        )
+        index_posts(cls._table, [p.id for p in posts])
+        cls.invalidate_lists(set(p.nereid_user.id for p in posts))
+        published = [p for p in posts if p.state == 'Published']
+        if published:
+            cls.invalidate_feeds(set(p.nereid_user.id for p in published))
+        return posts
+
+    @classmethod
+    def write(cls, posts, values, *args):
+        actions = iter((posts, values) + args)
+        args = []
+        to_index = []
+        in_feeds = []
+        all_users = False
+        for records, values in zip(actions, actions):
+            args.extend((records, cls._content_values(values)))
+            if 'title' in values or 'content' in values:
+                to_index.extend(p.id for p in records)
+            if FEED_FIELDS.intersection(values):
+                in_feeds.extend(records)
+            all_users |= 'nereid_user' in values
+        super(BlogPost, cls).write(*args)
+        index_posts(cls._table, to_index)
+        if in_feeds or all_users:
+            cls.invalidate_feeds(
+                set(p.nereid_user.id for p in in_feeds), all_users
+            )
+        written = [p for records in args[::2] for p in records]
+        cls.invalidate_lists(
+            set(p.nereid_user.id for p in written), all_users
+        )
+        cls.invalidate_caches(written)
+
+    @classmethod
+    def delete(cls, posts):
+        cls.invalidate_caches(posts)
+        user_ids = set(p.nereid_user.id for p in posts)
+        cls.invalidate_feeds(user_ids)
+        cls.invalidate_lists(user_ids)
+        unindex_posts([p.id for p in posts])
+        super(BlogPost, cls).delete(posts)
+
+    @classmethod
+    def invalidate_caches(cls, posts):
+        """
+        Drop the cached pages and uris of the given posts (or post ids) in
+        every worker process
+        """
+        dbname = Transaction().cursor.database_name
+        invalidation.invalidate(*[
+            (cls.__name__, dbname, int(post)) for post in posts
+        ])
+
+    @classmethod
+    def invalidate_feeds(cls, user_ids, all_users=False):
+        """
+        Drop the cached feeds of the users and the site wide feed in every
+        worker process, or the feeds of all the users if all_users is set
+        """
+        dbname = Transaction().cursor.database_name
+        tag = cls.__name__ + '.feed'
+        if all_users:
+            invalidation.invalidate((tag, dbname))
+        else:
+            invalidation.invalidate((tag, dbname, None), *[
+                (tag, dbname, user_id) for user_id in user_ids
+            ])
+
+    @classmethod
+    def invalidate_lists(cls, user_ids, all_users=False):
+        """
+        Drop the cached list timestamps of the users in every worker
+        process, or those of all the users if all_users is set
+        """
+        dbname = Transaction().cursor.database_name
+        tag = cls.__name__ + '.list'
+        if all_users:
+            invalidation.invalidate((tag, dbname))
+        else:
+            invalidation.invalidate(*[
+                (tag, dbname, user_id) for user_id in user_ids
+            ])
+
+    @classmethod
+    def get_feed(cls, user_id=None):
+        """
+        Return an (etag, updated, data) tuple for the Atom feed of the
+        latest published posts of the user, or of all the users if user_id
+        is None.
+
+        The entries show the excerpt of the posts so that their content is
+        never loaded. Feeds are cached until a post enters, leaves or
+        changes in them, see :meth:`invalidate_feeds`.
+        """
+        NereidUser = Pool().get('nereid.user')
+        dbname = Transaction().cursor.database_name
+        tag = cls.__name__ + '.feed'
+
+        key = (tag, dbname, user_id, request.host, Transaction().language)
+        invalidation.consume()
+        cached = feed_cache.get(key)
+        if cached is not None:
+            return cached
+
+        domain = [('state', '=', 'Published')]
+        if user_id is not None:
+            domain.append(('nereid_user', '=', user_id))
+            title = NereidUser(user_id).display_name
+        else:
+            title = request.nereid_website.name
+        posts = cls.search(
+            domain, limit=cls.feed_size,
+            order=[('post_date', 'DESC'), ('id', 'DESC')]
+        )
+        with timing('serialization'):
+            rows = dict((row['id'], row) for row in cls.read(
+                map(int, posts), [
+                    'title', 'uri', 'nereid_user', 'post_date', 'excerpt',
+                    'create_date', 'write_date',
+                ]
+            ))
+            authors = dict((row['id'], row['display_name']) for row in (
+                NereidUser.read(
+                    list(set(r['nereid_user'] for r in rows.values())),
+                    ['display_name']
+                )
+            ))
+
+            feed = AtomFeed(
+                title, feed_url=request.url, url=request.url_root
+            )
+            for post in posts:
+                row = rows[post.id]
+                url = url_for(
+                    'blog.post.render', user_id=row['nereid_user'],
+                    uri=row['uri'], _external=True
+                )
+                feed.add(
+                    row['title'], row['excerpt'], content_type='text',
+                    id=url, url=url, author=authors[row['nereid_user']],
+                    published=row['post_date'],
+                    updated=row['write_date'] or row['create_date'],
+                )
+            data = feed.to_string().encode('utf-8')
+        updated = max([entry.updated for entry in feed.entries] or [None])
+
+        value = (make_etag(data), updated, data)
+        feed_cache.set(key, value, tags=[(tag, dbname), (tag, dbname, user_id)])
+        return value
+
+    @classmethod
+    def render_feed(cls, user_id=None):
+        "Return the response for the Atom feed of the user or the site"
+        etag, updated, data = cls.get_feed(user_id)
+        rv = not_modified(etag, updated)
+        if rv is not None:
+            return rv
+        return add_validators(current_app.response_class(
+            data, mimetype='application/atom+xml'
+        ), etag, updated)
+
+    @classmethod
+    def resolve_uri(cls, user_id, uri):
+        """
+        Return a (id, state, timestamp) tuple for the post of the user with
+        the uri, where timestamp is the last time the post was written, or
+        None if there is no such post.
+
+        The tuples are cached per database and dropped whenever the post is
+        written, so the hot routes do not need a query to find the post.
+        """
+        cursor = Transaction().cursor
+        key = (cls.__name__, cursor.database_name, user_id, uri)
+        invalidation.consume()
+        value = uri_cache.get(key)
+        if value is not None:
+            return value
+
+        table = cls.__table__()
+        cursor.execute(*table.select(
+            table.id, table.state, table.write_date, table.create_date,
+            where=(table.nereid_user == user_id) & (table.uri == uri),
+            limit=1
+        ))
+        row = cursor.fetchone()
+        if not row:
+            return None
+        post_id, state, write_date, create_date = row
+        value = (post_id, state, write_date or create_date)
+        uri_cache.set(
+            key, value, tags=[(cls.__name__, cursor.database_name, post_id)]
+        )
+        return value
+
+    @classmethod
+    def uri_exists(cls, user_id, uri, exclude_id=None):
+        """
+        Return True if the user has a post with the uri, other than the
+        post exclude_id
+        """
+        table = cls.__table__()
+        cursor = Transaction().cursor
+
+        where = (table.nereid_user == user_id) & (table.uri == uri)
+        if exclude_id is not None:
+            where &= table.id != exclude_id
+        cursor.execute(*table.select(table.id, where=where, limit=1))
+        return cursor.fetchone() is not None
+
+    @classmethod
+    def get_free_uri(cls, user_id, uri, exclude_id=None):
+        """
+        Return uri suffixed with the number following the highest suffix
+        the user already has for it (uri-2, uri-3, ...), found with a single
+        query on the uris starting with uri.
+        """
+        table = cls.__table__()
+        cursor = Transaction().cursor
+
+        prefix = uri + '-'
+        where = (table.nereid_user == user_id) & \
+            table.uri.like(prefix + '%')
+        if exclude_id is not None:
+            where &= table.id != exclude_id
+        cursor.execute(*table.select(table.uri, where=where))
+        # _ is a wildcard for LIKE, so the prefix is checked again
+        suffixes = [
+            int(row[0][len(prefix):]) for row in cursor.fetchall()
+            if row[0].startswith(prefix) and row[0][len(prefix):].isdigit()
+        ]
+        return '%s%d' % (prefix, max(suffixes + [1]) + 1)
+
+    @classmethod
+    def get_list_timestamp(cls, user_id):
+        """
+        Return the number of posts of the user and the last time one of
+        them was written, as a tuple. Any post created, written or deleted
+        changes the tuple.
+
+        The tuple is cached per user until one of their posts changes, see
+        :meth:`invalidate_lists`, so the aggregate over the posts of the
+        user only runs once per change rather than on every request.
+        """
+        table = cls.__table__()
+        cursor = Transaction().cursor
+        tag = cls.__name__ + '.list'
+
+        key = (tag, cursor.database_name, user_id)
+        invalidation.consume()
+        value = list_cache.get(key)
+        if value is not None:
+            return value
+
+        cursor.execute(*table.select(
+            Count(table.id),
+            Max(Coalesce(table.write_date, table.create_date)),
+            where=table.nereid_user == user_id
+        ))
+        count, timestamp = cursor.fetchone()
+        if isinstance(timestamp, basestring):
+            # sqlite returns the aggregate as a string
+            timestamp = datetime.strptime(
+                timestamp, '%Y-%m-%d %H:%M:%S.%f' if '.' in timestamp
+                else '%Y-%m-%d %H:%M:%S'
+            )
+        value = (count, timestamp)
+        list_cache.set(key, value, tags=[key[:2], key])
+        return value
+
+    @classmethod
+    def _render_cache_key(cls, user_id, uri):
+        """
+        Return the key under which the page for the post at uri is cached,
+        or None if the page must not be served from the cache.
+
+        Only published posts viewed by guests without pending flash
+        messages are cached. The key is built from the id and the last
+        write timestamp of the post, as resolved by :meth:`resolve_uri`,
+        and from the website, whose templates render the page.
+        """
+        if not render_cache.size_limit or not request.is_guest_user or \
+                session.get('_flashes'):
+            return None
+
+        resolved = cls.resolve_uri(user_id, uri)
+        if resolved is None or resolved[1] != 'Published':
+            return None
+        post_id, _, timestamp = resolved
+        return (
+            cls.__name__, Transaction().cursor.database_name, post_id,
+            timestamp, request.nereid_website.id, Transaction().language,
+            request.is_xhr,
+        )
+
+    @classmethod
+    def search_after(
+            cls, domain, after=None, limit=None, undated_first=False):
+        """
+        Return a page of the posts matching domain, most recent first, and
+        the cursor of the next page (None on the last page).
+
+        Posts are ordered on (post_date, id) and the page is fetched with a
+        keyset condition on that pair instead of an OFFSET, so every page
+        costs the same and no COUNT is needed.
+
+        :param after: A cursor returned for the previous page. A false value
+                      returns the first page.
+        :param undated_first: Also list the posts without a post_date
+                              (drafts), ahead of the dated ones.
+        """
+        if limit is None:
+            limit = cls.per_page
+        post_date, post_id = decode_cursor(after) if after else (None, None)
+
+        posts = []
+        if undated_first and post_date is None:
+            undated = [('post_date', '=', None)]
+            if post_id is not None:
+                undated.append(('id', '<', post_id))
+            posts = cls.search(
+                domain + undated, limit=limit + 1, order=[('id', 'DESC')]
+            )
+            # Dated posts follow the undated ones from the top
+            post_id = None
+
+        if len(posts) <= limit:
+            dated = [('post_date', '!=', None)]
+            if post_id is not None:
+                dated.append([
+                    'OR',
+                    ('post_date', '<', post_date), [
+                        ('post_date', '=', post_date),
+                        ('id', '<', post_id),
+                    ]
+                ])
+            posts += cls.search(
+                domain + dated, limit=limit + 1 - len(posts),
+                order=[('post_date', 'DESC'), ('id', 'DESC')]
+            )
+
+        next_cursor = None
+        if len(posts) > limit:
+            posts = posts[:limit]
+            next_cursor = encode_cursor(posts[-1].post_date, posts[-1].id)
+        return posts, next_cursor
+
     def on_change_with_uri(self):
         if self.title and not self.uri:
             return slugify(self.title)
@@ -174,6 +1035,9 @@ class BlogPost(Workflow, ModelSQL, ModelView):
     def serialize(self, purpose=None):
         '''
         Return serializable dict for `self`
+
+        :param purpose: 'activity_stream' gives the excerpt as content and
+                        'list' leaves the content out.
         '''
         res = {
             'id': self.id,
@@ -185,18 +1049,79 @@ class BlogPost(Workflow, ModelSQL, ModelView):
             'state': self.state,
             'nereid_user': self.nereid_user.id,
             'displayName': self.rec_name,
+            'excerpt': self.excerpt,
+            'word_count': self.word_count,
+            'reading_time': self.reading_time,
+            'published_comment_count': self.published_comment_count,
         }
         if purpose == 'activity_stream':
             res['objectType'] = self.__name__
-            res['content'] = self.content[0:50]
-        else:
+            res['content'] = self.excerpt
+        elif purpose != 'list':
             res['content'] = self.content
+            res['content_html'] = self.content_html
+
+        return res
+
+    @classmethod
+    def serialize_many(cls, posts, purpose=None):
+        """
+        Return the serializable dicts for posts, in the same order.
+
+        Unlike calling :meth:`serialize` on each post, the values of all
+        the posts are fetched with a single read() and the related records
+        are never loaded. The content is only read if the purpose needs it.
+        """
+        fields_names = [
+            'title', 'uri', 'post_date', 'allow_guest_comments', 'state',
+            'nereid_user', 'rec_name', 'excerpt', 'word_count',
+            'reading_time', 'published_comment_count',
+        ]
+        if purpose not in ('activity_stream', 'list'):
+            fields_names.extend(['content', 'content_html'])
+        with timing('serialization'):
+            values = dict((v['id'], v) for v in cls.read(
+                [p.id for p in posts], fields_names
+            ))
+            return [
+                cls.serialize_values(values[p.id], purpose) for p in posts
+            ]
+
+    @classmethod
+    def serialize_values(cls, values, purpose=None):
+        """
+        Return the serializable dict for a post from the values returned by
+        read()
+        """
+        res = {
+            'id': values['id'],
+            'title': values['title'],
+            'uri': values['uri'],
+            'post_date': values['post_date'].isoformat()
+                if values['post_date'] else None,
+            'allow_guest_comments': values['allow_guest_comments'],
+            'state': values['state'],
+            'nereid_user': values['nereid_user'],
+            'displayName': values['rec_name'],
+            'excerpt': values['excerpt'],
+            'word_count': values['word_count'],
+            'reading_time': values['reading_time'],
+            'published_comment_count': values['published_comment_count'],
+        }
+        if purpose == 'activity_stream':
+            res['objectType'] = cls.__name__
+            res['content'] = values['excerpt']
+        elif purpose != 'list':
+            res['content'] = values['content']
+            res['content_html'] = values['content_html']
 
         return res
 
     @classmethod
     @route('/post/-new', methods=['GET', 'POST'])
+    @instrumented
     @login_required
+    @rate_limited('post')
     def new_post(cls):
         """Create a new post
         """
@@ -234,18 +1159,16 @@ class BlogPost(Workflow, ModelSQL, ModelView):
         """
             Return post for current user and uri
         """
-        posts = cls.search([
-            ('uri', '=', uri),
-            ('nereid_user', '=', request.nereid_user.id),
-        ])
+        resolved = cls.resolve_uri(request.nereid_user.id, uri)
 
-        if not posts:
+        if resolved is None:
             abort(404)
 
-        return posts[0]
+        return cls(resolved[0])
 
     @classmethod
     @route('/post/<uri>/-edit', methods=['GET', 'POST'])
+    @instrumented
     @login_required
     def edit_post_for_uri(cls, uri):
         """
@@ -254,6 +1177,7 @@ class BlogPost(Workflow, ModelSQL, ModelView):
         return cls.get_post_for_uri(uri).edit_post()
 
     @route('/post/<int:active_id>/-edit', methods=['GET', 'POST'])
+    @instrumented
     @login_required
     def edit_post(self):
         """
@@ -268,7 +1192,9 @@ class BlogPost(Workflow, ModelSQL, ModelView):
         with Transaction().set_context(blog_id=self.id):
             if request.method == 'POST' and post_form.validate():
                 self.title = post_form.title.data
-                self.content = post_form.content.data
+                if post_form.content.data != self.content:
+                    # Avoid rendering the content again if it is unchanged
+                    self.content = post_form.content.data
                 self.allow_guest_comments = post_form.allow_guest_comments.data
                 self.save()
                 flash('Your post has been updated.')
@@ -289,6 +1215,7 @@ class BlogPost(Workflow, ModelSQL, ModelView):
 
     @classmethod
     @route('/post/<uri>/-change-state', methods=['POST'])
+    @instrumented
     @login_required
     def change_state_for_uri(cls, uri):
         "Change the state of the post for uri"
@@ -296,6 +1223,7 @@ class BlogPost(Workflow, ModelSQL, ModelView):
         return cls.get_post_for_uri(uri).change_state()
 
     @route('/post/<int:active_id>/-change-state', methods=['POST'])
+    @instrumented
     @login_required
     def change_state(self):
         "Change the state of the post"
@@ -317,8 +1245,47 @@ class BlogPost(Workflow, ModelSQL, ModelView):
             uri=self.uri
         ))
 
+    @classmethod
+    @route('/posts/-change-state', methods=['POST'])
+    @instrumented
+    @login_required
+    def change_states(cls):
+        """
+        Change the state of several posts of the logged in user
+
+        The form gives the `state` (publish, archive or draft) and the
+        `ids` of the posts, repeated or comma separated. Posts of other
+        users are reported as not found.
+        """
+        state = request.form.get('state')
+        if state not in TRANSITION_STATES:
+            abort(400)
+        try:
+            post_ids = [
+                int(post_id)
+                for value in request.form.getlist('ids')
+                for post_id in value.split(',') if post_id.strip()
+            ]
+        except ValueError:
+            abort(400)
+
+        results = cls.bulk_change_state(
+            post_ids, state, nereid_user=request.nereid_user.id
+        )
+        changed = len([r for r in results if r['success']])
+        if request.is_xhr:
+            return jsonify({
+                'success': changed == len(results),
+                'results': results,
+            })
+        flash('%d of %d posts are now %s' % (
+            changed, len(results), TRANSITION_STATES[state]
+        ))
+        return redirect(url_for('blog.post.my_posts'))
+
     @classmethod
     @route('/post/<uri>/-change-guest-permission', methods=['POST'])
+    @instrumented
     @login_required
     def change_guest_permission_for_uri(cls, uri):
         "Change guest permission for uri"
@@ -326,6 +1293,7 @@ class BlogPost(Workflow, ModelSQL, ModelView):
         return cls.get_post_for_uri(uri).change_guest_permission()
 
     @route('/post/<int:active_id>/-change-guest-permission', methods=['POST'])
+    @instrumented
     @login_required
     def change_guest_permission(self):
         "Change guest permission of the post"
@@ -348,10 +1316,43 @@ class BlogPost(Workflow, ModelSQL, ModelView):
 
     @classmethod
     @route('/post/<int:user_id>/<uri>')
+    @instrumented
     def render(cls, user_id, uri):
-        "Render the blog post"
+        """
+        Render the blog post
+
+        The response carries an ETag and a Last-Modified date derived from
+        the last write of the post, which is modified by every new comment,
+        and conditional requests are answered with a 304 before anything is
+        rendered.
+        """
         NereidUser = Pool().get('nereid.user')
 
+        resolved = cls.resolve_uri(user_id, uri)
+        if resolved is None:
+            abort(404)
+        post_id, state, timestamp = resolved
+
+        if not (state == 'Published' or request.nereid_user.id == user_id):
+            abort(403)
+
+        etag = make_etag(
+            Transaction().cursor.database_name, post_id, timestamp,
+            request.nereid_user.id, Transaction().language, request.is_xhr
+        )
+        rv = not_modified(etag, timestamp)
+        if rv is not None:
+            return rv
+
+        cache_key = cls._render_cache_key(user_id, uri)
+        if cache_key is not None:
+            cached = render_cache.get(cache_key)
+            if cached is not None:
+                data, content_type = cached
+                return add_validators(current_app.response_class(
+                    data, content_type=content_type
+                ), etag, timestamp)
+
         if 're_captcha_public' in CONFIG.options and request.is_guest_user:
             comment_form = GuestCommentForm(
                 captcha={'ip_address': request.remote_addr}
@@ -360,76 +1361,227 @@ class BlogPost(Workflow, ModelSQL, ModelView):
             comment_form = PostCommentForm()
 
         user = NereidUser(user_id)
-
-        posts = cls.search([
-            ('nereid_user', '=', user.id),
-            ('uri', '=', uri),
-        ])
-        if not posts:
-            abort(404)
-
-        # if only one post is found then it is rendered and
-        # if more than one are found then the first one is rendered
-        post = posts[0]
-
-        if not (post.state == 'Published' or
-                request.nereid_user == post.nereid_user):
-            abort(403)
+        post = cls(post_id)
 
         if request.is_xhr:
-            return jsonify(post.serialize())
-        return render_template(
-            'blog_post.jinja', post=post, comment_form=comment_form,
-            poster=user
-        )
+            rv = jsonify(post.serialize())
+        else:
+            rv = render_template(
+                'blog_post.jinja', post=post, comment_form=comment_form,
+                poster=user
+            )
+        if cache_key is not None:
+            # Only the body is cached, the response itself is built afresh
+            # on every hit so that cookies and headers are never shared
+            # between requests.
+            rv = make_response(rv)
+            if rv.status_code == 200:
+                render_cache.set(
+                    cache_key, (rv.data, rv.headers.get('Content-Type')),
+                    tags=[cache_key[:3]]
+                )
+        return add_validators(rv, etag, timestamp)
 
     @classmethod
     @route('/posts/<int:user_id>')
     @route('/posts/<int:user_id>/<int:page>')
+    @instrumented
     def render_list(cls, user_id, page=1):
         """Render the blog posts for a user
         This should render the list of only published posts of the user
+
+        If an `after` argument is given (even empty) the posts are paginated
+        with a cursor instead of a page number, see :meth:`search_after`.
+
+        Conditional requests are answered with a 304 if none of the posts
+        of the user changed, see :meth:`get_list_timestamp`.
         """
         NereidUser = Pool().get('nereid.user')
 
-        user = NereidUser(user_id)
+        count, timestamp = cls.get_list_timestamp(user_id)
+        etag = make_etag(
+            Transaction().cursor.database_name, user_id, count, timestamp,
+            request.nereid_user.id, Transaction().language, request.is_xhr
+        )
+        rv = not_modified(etag, timestamp)
+        if rv is not None:
+            return rv
 
-        posts = Pagination(cls, [
+        user = NereidUser(user_id)
+        domain = [
             ('nereid_user', '=', user.id),
             ('state', '=', 'Published'),
-        ], page, cls.per_page)
+        ]
+
+        after = request.args.get('after')
+        if after is not None:
+            posts, next_cursor = cls.search_after(domain, after)
+            if request.is_xhr:
+                rv = jsonify({
+                    'has_next': next_cursor is not None,
+                    'next_cursor': next_cursor,
+                    'items': cls.serialize_many(posts, 'list'),
+                })
+            else:
+                rv = render_template(
+                    'blog_posts.jinja', posts=posts, poster=user,
+                    next_cursor=next_cursor
+                )
+            return add_validators(rv, etag, timestamp)
+
+        posts = Pagination(cls, domain, page, cls.per_page)
         if request.is_xhr:
-            return jsonify({
+            rv = jsonify({
                 'has_next': posts.has_next,
                 'has_prev': posts.has_prev,
-                'items': [post.serialize() for post in posts],
+                'items': cls.serialize_many(list(posts), 'list'),
             })
+        else:
+            rv = render_template(
+                'blog_posts.jinja', posts=posts, poster=user
+            )
+        return add_validators(rv, etag, timestamp)
+
+    @classmethod
+    @route('/posts/-latest')
+    @instrumented
+    def render_latest(cls):
+        """
+        Render the latest published posts of all the users
 
+        The posts are paginated with the `after` cursor argument, see
+        :meth:`search_after`. Pages are read from the partial index on the
+        dates of the published posts, so they cost the same whatever the
+        number of posts and users.
+        """
+        posts, next_cursor = cls.search_after(
+            [('state', '=', 'Published')], request.args.get('after')
+        )
+        if request.is_xhr:
+            return jsonify({
+                'has_next': next_cursor is not None,
+                'next_cursor': next_cursor,
+                'items': cls.serialize_many(posts, 'list'),
+            })
         return render_template(
-            'blog_posts.jinja', posts=posts, poster=user
+            'blog_posts_latest.jinja', posts=posts, next_cursor=next_cursor
         )
 
     @classmethod
     @route('/posts/-my')
     @route('/posts/-my/<int:page>')
+    @instrumented
     @login_required
     def my_posts(self, page=1):
         """Render all the posts of the logged in user
+
+        Like :meth:`render_list`, accepts an `after` argument for cursor
+        pagination. Drafts are listed first in that mode.
         """
-        posts = Pagination(self, [
+        domain = [
             ('nereid_user', '=', request.nereid_user.id),
-        ], page, self.per_page)
+        ]
+
+        after = request.args.get('after')
+        if after is not None:
+            posts, next_cursor = self.search_after(
+                domain, after, undated_first=True
+            )
+            if request.is_xhr:
+                return jsonify({
+                    'has_next': next_cursor is not None,
+                    'next_cursor': next_cursor,
+                    'items': self.serialize_many(posts, 'list'),
+                })
+            return render_template(
+                'my_blog_posts.jinja', posts=posts, next_cursor=next_cursor
+            )
+
+        posts = Pagination(self, domain, page, self.per_page)
         if request.is_xhr:
             return jsonify({
                 'has_next': posts.has_next,
                 'has_prev': posts.has_prev,
-                'items': [post.serialize() for post in posts],
+                'items': self.serialize_many(list(posts), 'list'),
             })
 
         return render_template('my_blog_posts.jinja', posts=posts)
 
+    @classmethod
+    @route('/posts/-search')
+    @route('/posts/-search/<int:page>')
+    @instrumented
+    def render_search(cls, page=1):
+        """
+        Render the published posts matching the `q` argument, best matches
+        first. The search uses the full text index of the posts, on the
+        backends without one the route answers with a 501.
+        """
+        if not search_available():
+            abort(501)
+        page = max(page, 1)
+        text = request.args.get('q', '').strip()
+
+        posts, has_next = [], False
+        if text:
+            post_ids = search_posts(
+                cls._table, text, offset=(page - 1) * cls.per_page,
+                limit=cls.per_page + 1
+            )
+            has_next = len(post_ids) > cls.per_page
+            posts = cls.browse(post_ids[:cls.per_page])
+
+        if request.is_xhr:
+            return jsonify({
+                'q': text,
+                'has_next': has_next,
+                'has_prev': page > 1,
+                'items': cls.serialize_many(posts, 'list'),
+            })
+        return render_template(
+            'blog_post_search.jinja', posts=posts, q=text, page=page,
+            has_next=has_next
+        )
+
+    @classmethod
+    @route('/posts/feed.atom')
+    @instrumented
+    def site_feed(cls):
+        "Atom feed of the latest published posts of all the users"
+        return cls.render_feed()
+
+    @classmethod
+    @route('/posts/<int:user_id>/feed.atom')
+    @instrumented
+    def user_feed(cls, user_id):
+        "Atom feed of the latest published posts of the user"
+        return cls.render_feed(user_id)
+
+    @classmethod
+    @route('/posts/-stats')
+    @login_required
+    def stats(cls):
+        """
+        Return the statistics of the instrumented routes and of the caches
+        as json. Only available to logged in users when the
+        instrumentation is enabled.
+        """
+        if not is_enabled():
+            abort(404)
+        return jsonify(
+            routes=route_stats(),
+            caches={
+                'render': render_cache.stats(),
+                'uri': uri_cache.stats(),
+                'feed': feed_cache.stats(),
+                'list': list_cache.stats(),
+            },
+            rate_limits=rate_limit_stats(),
+        )
+
     @classmethod
     @route('/post/<int:user_id>/<uri>/-comment', methods=['GET', 'POST'])
+    @instrumented
     def add_comment(cls, user_id, uri):
         '''
         Add a comment
@@ -439,21 +1591,23 @@ class BlogPost(Workflow, ModelSQL, ModelView):
             DeprecationWarning,
         )
         # Comments can only be added to published posts
-        posts = cls.search([
-            ('nereid_user', '=', user_id),
-            ('uri', '=', uri),
-        ], limit=1)
-        if not posts:
+        resolved = cls.resolve_uri(user_id, uri)
+        if resolved is None:
             abort(404)
 
-        return posts[0].render_comments()
+        return cls(resolved[0]).render_comments()
 
     @route('/post/<int:active_id>/-comment', methods=['GET', 'POST'])
+    @instrumented
+    @rate_limited('comment')
     def render_comments(self):
         """
         Render comments
 
-        GET: Return json of all the comments of this post.
+        GET: Return json of the comments of this post, oldest first.
+             `limit` and `after` (the id of the last comment received)
+             arguments paginate the comments. With `format=ndjson` the
+             comments are streamed as newline delimited json instead.
         POST: Create new comment for this post.
         """
         if self.state != 'Published':
@@ -469,14 +1623,7 @@ class BlogPost(Workflow, ModelSQL, ModelView):
             comment_form = PostCommentForm(request.form)
 
         if request.method == 'GET':
-            if self.nereid_user == request.nereid_user:
-                return jsonify(comments=[
-                    comment.serialize() for comment in self.comments
-                ])
-            return jsonify(comments=[
-                comment.serialize() for comment in self.comments
-                if not comment.is_spam
-            ])
+            return self.get_comments()
 
         # If post does not allow guest comments,
         # then dont allow guest user to comment
@@ -492,16 +1639,31 @@ class BlogPost(Workflow, ModelSQL, ModelView):
             ))
 
         if request.method == 'POST' and comment_form.validate():
-            self.write([self], {
-                'comments': [('create', [{
-                    'nereid_user': current_user.id
-                        if not current_user.is_anonymous() else None,
-                    'name': current_user.display_name
-                        if not current_user.is_anonymous()
-                            else comment_form.name.data,
-                    'content': comment_form.content.data,
-                }])]
-            })
+            values = {
+                'nereid_user': current_user.id
+                    if not current_user.is_anonymous() else None,
+                'name': current_user.display_name
+                    if not current_user.is_anonymous()
+                        else comment_form.name.data,
+                'content': comment_form.content.data,
+                'ip_address': request.remote_addr,
+            }
+            if comment_queue_enabled():
+                # The comment is inserted later by the queue worker, without
+                # locking the post now
+                CommentQueue = Pool().get('blog.post.comment.queue')
+                values['post'] = self.id
+                CommentQueue.create([values])
+                if request.is_xhr:
+                    rv = jsonify(success=True, queued=True)
+                    rv.status_code = 202
+                    return rv
+                flash('Your comment will be published shortly')
+                return redirect(url_for(
+                    'blog.post.render', user_id=self.nereid_user.id,
+                    uri=self.uri
+                ))
+            self.write([self], {'comments': [('create', [values])]})
 
         if request.is_xhr:
             return jsonify(success=True) if comment_form.validate() \
@@ -510,6 +1672,53 @@ class BlogPost(Workflow, ModelSQL, ModelView):
             'blog.post.render', user_id=self.nereid_user.id, uri=self.uri
         ))
 
+    def get_comments(self):
+        """
+        Return the response for a GET on the comments of the post.
+
+        Spam is filtered out by the query unless the post owner is asking.
+        Conditional requests are answered with a 304 when neither the post
+        nor its comments changed, before any comment is read.
+        """
+        Comment = Pool().get('blog.post.comment')
+
+        is_owner = self.nereid_user == request.nereid_user
+        timestamp = self.write_date or self.create_date
+        etag = make_etag(
+            Transaction().cursor.database_name, self.id, timestamp,
+            self.comment_count, self.published_comment_count, is_owner
+        )
+        rv = not_modified(etag, timestamp)
+        if rv is not None:
+            return rv
+
+        domain = [('post', '=', self.id)]
+        if not is_owner:
+            domain.append(('is_spam', '=', False))
+        after = request.args.get('after', type=int)
+        if after:
+            domain.append(('id', '>', after))
+
+        if request.args.get('format') == 'ndjson':
+            return add_validators(current_app.response_class(
+                Comment.stream_serialized(domain),
+                mimetype='application/x-ndjson'
+            ), etag, timestamp)
+
+        limit = request.args.get('limit', type=int)
+        if limit is not None:
+            limit = max(1, min(limit, self.comments_max_limit))
+        comments = Comment.search_serialized(
+            domain, limit=limit and limit + 1, order=[('id', 'ASC')]
+        )
+        has_next = limit is not None and len(comments) > limit
+        comments = comments[:limit]
+        return add_validators(jsonify(
+            comments=comments,
+            has_next=has_next,
+            next_after=comments[-1]['id'] if has_next else None,
+        ), etag, timestamp)
+
 
 class BlogPostComment(ModelSQL, ModelView):
     'Blog Post Comment'
@@ -530,11 +1739,143 @@ class BlogPostComment(ModelSQL, ModelView):
     content = fields.Text('Content', required=True)
     create_date = fields.DateTime('Create Date', readonly=True)
     is_spam = fields.Boolean('Is Spam ?')
+    spam_trained = fields.Boolean(
+        'Spam Trained', readonly=True,
+        help='The spam classifier was trained with this comment as it is '
+        'flagged'
+    )
+    ip_address = fields.Char('IP Address', readonly=True, select=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(BlogPostComment, cls).__setup__()
+        cls.__rpc__.update({
+            'rescore_spam': RPC(readonly=False),
+        })
 
     @staticmethod
     def default_is_spam():
         return False
 
+    @staticmethod
+    def default_spam_trained():
+        return False
+
+    @classmethod
+    def create(cls, vlist):
+        comments = super(BlogPostComment, cls).create(
+            [cls._spam_values(values) for values in vlist]
+        )
+        cls.update_post_counters(added=comments)
+        return comments
+
+    @staticmethod
+    def _spam_values(values):
+        """
+        Return values with is_spam set by the spam classifier, unless it is
+        given or the classifier can not tell
+        """
+        if 'is_spam' in values:
+            return values
+        is_spam = spam.classify(values.get('content'), values.get('name'))
+        if is_spam is None:
+            return values
+        values = values.copy()
+        values['is_spam'] = is_spam
+        return values
+
+    @classmethod
+    def rescore_spam(cls, comments=None, chunk_size=500):
+        """
+        Flag as spam the comments (all of them by default) the classifier
+        finds to be spam, chunk_size comments at a time. Comments are never
+        unflagged, nor are those the classifier was trained with, so the
+        decisions of the post owners stand.
+        """
+        table = cls.__table__()
+        cursor = Transaction().cursor
+
+        def rescore(where):
+            cursor.execute(*table.select(
+                table.id, table.content, table.name,
+                where=where & ~table.is_spam & ~table.spam_trained,
+                order_by=table.id,
+                limit=chunk_size
+            ))
+            rows = cursor.fetchall()
+            to_flag = [
+                comment_id for comment_id, content, name in rows
+                if spam.classify(content, name)
+            ]
+            if to_flag:
+                cls.write(cls.browse(to_flag), {'is_spam': True})
+            return rows
+
+        if comments is None:
+            last_id = 0
+            while True:
+                rows = rescore(table.id > last_id)
+                if len(rows) < chunk_size:
+                    break
+                last_id = rows[-1][0]
+        else:
+            comment_ids = map(int, comments)
+            for i in range(0, len(comment_ids), chunk_size):
+                rescore(table.id.in_(comment_ids[i:i + chunk_size]))
+
+    @classmethod
+    def write(cls, comments, values, *args):
+        all_comments = [
+            c for records in (comments,) + args[::2] for c in records
+        ]
+        if not any(
+                'post' in v or 'is_spam' in v for v in (values,) + args[1::2]):
+            super(BlogPostComment, cls).write(comments, values, *args)
+            cls.invalidate_post_caches(all_comments)
+            return
+        removed = cls.read(map(int, all_comments), ['post', 'is_spam'])
+        super(BlogPostComment, cls).write(comments, values, *args)
+        cls.update_post_counters(added=all_comments, removed=removed)
+
+    @classmethod
+    def delete(cls, comments):
+        removed = cls.read(map(int, comments), ['post', 'is_spam'])
+        super(BlogPostComment, cls).delete(comments)
+        cls.update_post_counters(removed=removed)
+
+    @classmethod
+    def update_post_counters(cls, added=None, removed=None):
+        """
+        Update the comment counters of the posts for the comments added
+        and the comments removed, given as values read for the post and
+        is_spam fields.
+        """
+        BlogPost = Pool().get('blog.post')
+
+        deltas = {}
+        for rows, sign in ((removed or [], -1), (added or [], 1)):
+            if rows and not isinstance(rows[0], dict):
+                rows = cls.read(map(int, rows), ['post', 'is_spam'])
+            for row in rows:
+                total, published = deltas.get(row['post'], (0, 0))
+                deltas[row['post']] = (
+                    total + sign,
+                    published + (0 if row['is_spam'] else sign),
+                )
+        BlogPost.update_comment_counts(deltas)
+
+    @classmethod
+    def invalidate_post_caches(cls, comments):
+        """
+        Mark the posts the comments belong to as modified, which drops
+        their cached pages and changes their entity tags
+        """
+        BlogPost = Pool().get('blog.post')
+
+        BlogPost.write(
+            BlogPost.browse(list(set(c.post.id for c in comments))), {}
+        )
+
     def serialize(self):
         """
         Return Serializable dict. for this comment.
@@ -549,15 +1890,113 @@ class BlogPostComment(ModelSQL, ModelView):
             'is_spam': self.is_spam,
         }
 
+    @classmethod
+    def serialize_many(cls, comments, purpose=None):
+        """
+        Return the serializable dicts for comments, in the same order.
+
+        The values are fetched with a single read() of only the fields
+        :meth:`serialize` needs, without loading the post or the user of
+        the comments.
+        """
+        with timing('serialization'):
+            values = dict((v['id'], v) for v in cls.read(
+                [c.id for c in comments], [
+                    'post', 'nereid_user', 'name', 'content', 'create_date',
+                    'is_spam',
+                ]
+            ))
+            return [cls.serialize_values(values[c.id]) for c in comments]
+
+    @classmethod
+    def search_serialized(cls, domain, offset=0, limit=None, order=None):
+        """
+        Return the serialized comments matching domain as plain dicts,
+        see :meth:`serialize_many`.
+        """
+        return cls.serialize_many(cls.search(
+            domain, offset=offset, limit=limit, order=order
+        ))
+
+    @staticmethod
+    def serialize_values(values):
+        """
+        Return the serializable dict for a comment from the values
+        returned by read()
+        """
+        return {
+            'post': values['post'],
+            'id': values['id'],
+            'nereid_user': values['nereid_user'],
+            'name': values['name'],
+            'content': values['content'],
+            'create_date': values['create_date'].isoformat(),
+            'is_spam': values['is_spam'],
+        }
+
+    @classmethod
+    def stream_serialized(cls, domain, chunk_size=500):
+        """
+        Return a generator of the serialized comments matching domain as
+        lines of json. The comments are fetched from the database in the
+        order of their ids, chunk_size comments at a time.
+
+        The generator is consumed after the request handler has returned,
+        so if the transaction of the request is over by then, a new one is
+        started for the duration of the stream.
+        """
+        transaction = Transaction()
+        database_name = transaction.cursor.database_name
+        user, context = transaction.user, transaction.context.copy()
+
+        def fetch():
+            last_id = 0
+            while True:
+                comments = cls.search_serialized(
+                    domain + [('id', '>', last_id)], limit=chunk_size,
+                    order=[('id', 'ASC')]
+                )
+                for comment in comments:
+                    yield json.dumps(comment) + '\n'
+                if len(comments) < chunk_size:
+                    return
+                last_id = comments[-1]['id']
+
+        def stream():
+            if Transaction().cursor is not None:
+                for line in fetch():
+                    yield line
+                return
+            with Transaction().start(database_name, user, context=context):
+                for line in fetch():
+                    yield line
+
+        return stream()
+
     @route('/comment/<int:active_id>/-spam', methods=['POST'])
+    @instrumented
     @login_required
     def manage_spam(self):
-        "Mark the comment as spam"
+        """
+        Mark the comment as spam
+
+        The spam classifier is only trained when the flag changes. If it
+        was trained with the comment before, the comment is moved from
+        the other kind rather than counted twice.
+        """
         if not self.post.nereid_user == request.nereid_user:
             abort(403)
 
-        self.is_spam = request.form.get('spam', False, type=bool)
-        self.save()
+        is_spam = request.form.get('spam', False, type=bool)
+        if is_spam != self.is_spam:
+            comments = [(self.content, self.name)]
+            if self.spam_trained:
+                spam.train([], is_spam, moved=comments)
+            else:
+                spam.train(comments, is_spam)
+            self.is_spam = is_spam
+            self.spam_trained = True
+            self.save()
 
         if request.is_xhr:
             return jsonify({
@@ -569,3 +2008,175 @@ class BlogPostComment(ModelSQL, ModelView):
                 'blog.post.render', user_id=self.post.nereid_user.id,
                 uri=self.post.uri
             ))
+
+    @classmethod
+    def bulk_mark_spam(
+            cls, nereid_user, is_spam, ids=None, post=None, name=None,
+            ip_address=None, after=None):
+        """
+        Set is_spam on the comments of the posts of nereid_user matching
+        all the criteria given, and train the spam classifier with them.
+        Return the ids of the comments changed.
+
+        The comments are selected, and their ownership checked, with a
+        join on the posts (one query per IN_MAX ids), then updated with a
+        single write which keeps the comment counters of the posts right.
+
+        :param ids: ids of the comments
+        :param post: id of the post of the comments
+        :param name: name of the author of the comments
+        :param ip_address: address the comments were posted from
+        :param after: only the comments created after this datetime
+        """
+        BlogPost = Pool().get('blog.post')
+        comment = cls.__table__()
+        post_table = BlogPost.__table__()
+        cursor = Transaction().cursor
+
+        where = (post_table.nereid_user == int(nereid_user)) & (
+            comment.is_spam == (not is_spam)
+        )
+        if post is not None:
+            where &= comment.post == int(post)
+        if name is not None:
+            where &= comment.name == name
+        if ip_address is not None:
+            where &= comment.ip_address == ip_address
+        if after is not None:
+            where &= comment.create_date > after
+        query = comment.join(
+            post_table, condition=comment.post == post_table.id
+        )
+
+        comment_ids = []
+        if ids is None:
+            cursor.execute(*query.select(comment.id, where=where))
+            comment_ids = [row[0] for row in cursor.fetchall()]
+        else:
+            ids = map(int, ids)
+            for i in range(0, len(ids), cursor.IN_MAX):
+                cursor.execute(*query.select(
+                    comment.id,
+                    where=where & comment.id.in_(ids[i:i + cursor.IN_MAX])
+                ))
+                comment_ids.extend(row[0] for row in cursor.fetchall())
+        if not comment_ids:
+            return []
+
+        rows = cls.read(comment_ids, ['content', 'name', 'spam_trained'])
+        cls.write(cls.browse(comment_ids), {
+            'is_spam': is_spam,
+            'spam_trained': True,
+        })
+        spam.train([
+            (row['content'], row['name'])
+            for row in rows if not row['spam_trained']
+        ], is_spam, moved=[
+            (row['content'], row['name'])
+            for row in rows if row['spam_trained']
+        ])
+        return comment_ids
+
+    @classmethod
+    @route('/comments/-spam', methods=['POST'])
+    @instrumented
+    @login_required
+    def bulk_manage_spam(cls):
+        """
+        Mark many comments of the posts of the logged in user as spam, or
+        as not spam with `spam=false`.
+
+        The comments are given by their `ids`, repeated or comma separated,
+        or by any of the `post`, `name`, `ip_address` and `after` (an ISO
+        8601 date) filters. At least one of them is required.
+        """
+        is_spam = request.form.get('spam', 'true').lower() in (
+            '1', 'true', 'yes', 'on'
+        )
+        criteria = {}
+        try:
+            if request.form.get('ids'):
+                criteria['ids'] = [
+                    int(comment_id)
+                    for value in request.form.getlist('ids')
+                    for comment_id in value.split(',') if comment_id.strip()
+                ]
+            if request.form.get('post'):
+                criteria['post'] = int(request.form['post'])
+            if request.form.get('after'):
+                criteria['after'] = datetime.strptime(
+                    request.form['after'][:19], '%Y-%m-%dT%H:%M:%S'
+                )
+        except ValueError:
+            abort(400)
+        for key in ('name', 'ip_address'):
+            if request.form.get(key):
+                criteria[key] = request.form[key]
+        if not criteria:
+            abort(400)
+
+        comment_ids = cls.bulk_mark_spam(
+            request.nereid_user.id, is_spam, **criteria
+        )
+        if request.is_xhr:
+            return jsonify({
+                'success': True,
+                'count': len(comment_ids),
+                'ids': comment_ids,
+            })
+        flash('%d comments have been updated' % len(comment_ids))
+        return redirect(url_for('blog.post.my_posts'))
+
+
+class BlogPostCommentQueue(ModelSQL):
+    'Blog Post Comment Queue'
+    # Comments posted while the blog_comment_queue option is on wait here
+    # until process() inserts them in batches, so that posting a comment
+    # does not lock the post.
+    __name__ = 'blog.post.comment.queue'
+
+    post = fields.Many2One(
+        'blog.post', 'Blog Post', required=True, ondelete='CASCADE'
+    )
+    nereid_user = fields.Many2One('nereid.user', 'Nereid User')
+    name = fields.Char('Name')
+    content = fields.Text('Content', required=True)
+    ip_address = fields.Char('IP Address')
+
+    @classmethod
+    def process(cls, batch_size=500):
+        """
+        Insert the queued comments, oldest first, batch_size at a time.
+        Meant to be run by the cron.
+
+        The comments keep the date they were queued at as their creation
+        date, so that they are dated when they were posted rather than
+        when the cron ran.
+        """
+        Comment = Pool().get('blog.post.comment')
+        comment = Comment.__table__()
+        cursor = Transaction().cursor
+
+        while True:
+            queued = cls.search([], order=[('id', 'ASC')], limit=batch_size)
+            if not queued:
+                break
+            rows = cls.read(map(int, queued), [
+                'post', 'nereid_user', 'name', 'content', 'ip_address',
+                'create_date',
+            ])
+            comments = Comment.create([{
+                'post': row['post'],
+                'nereid_user': row['nereid_user'],
+                'name': row['name'],
+                'content': row['content'],
+                'ip_address': row['ip_address'],
+            } for row in rows])
+            for row, record in zip(rows, comments):
+                cursor.execute(*comment.update(
+                    [comment.create_date], [row['create_date']],
+                    where=comment.id == record.id
+                ))
+            cls.delete(queued)
+            if len(queued) < batch_size:
+                break
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""
+    cache
+
+    Process local caches used by the blog
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import time
+from collections import OrderedDict
+from threading import RLock
+
+from trytond.config import CONFIG
+
+__all__ = [
+    'LRUCache', 'render_cache', 'uri_cache', 'feed_cache', 'list_cache',
+    'spam_cache',
+]
+
+
+class LRUCache(object):
+    """
+    A thread safe, size bounded LRU cache with an optional time to live.
+
+    Entries can be stored with a set of tags, which lets all the entries
+    related to a record (for example every rendered page of a post) be
+    dropped together with :meth:`invalidate`.
+
+    :param size_limit: Maximum number of entries held by the cache
+    :param ttl: Seconds after which an entry expires. `None` disables
+                expiry.
+    """
+
+    def __init__(self, size_limit=1024, ttl=None):
+        self.size_limit = size_limit
+        self.ttl = ttl
+        self._lock = RLock()
+        self._entries = OrderedDict()
+        self._tags = {}
+        self.hits = self.misses = self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """
+        Return the value cached for key or default if there is no fresh
+        entry for it. A successful lookup marks the entry as most recently
+        used.
+        """
+        with self._lock:
+            try:
+                value, tags, expires = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires is not None and expires < time.time():
+                self._forget(key, tags)
+                self.misses += 1
+                return default
+            self._entries[key] = (value, tags, expires)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, tags=()):
+        """
+        Store value for key, evicting the least recently used entries if
+        the cache is full.
+        """
+        expires = time.time() + self.ttl if self.ttl else None
+        tags = frozenset(tags)
+        with self._lock:
+            if key in self._entries:
+                self._forget(key, self._entries.pop(key)[1])
+            self._entries[key] = (value, tags, expires)
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.size_limit:
+                old_key, (_, old_tags, _) = self._entries.popitem(last=False)
+                self._forget(old_key, old_tags)
+                self.evictions += 1
+
+    def invalidate(self, *tags):
+        """
+        Drop every entry stored with any of the given tags
+        """
+        with self._lock:
+            for tag in tags:
+                for key in self._tags.pop(tag, ()):
+                    entry = self._entries.pop(key, None)
+                    if entry is not None:
+                        self._forget(key, entry[1])
+
+    def clear(self):
+        "Drop all the entries from the cache"
+        with self._lock:
+            self._entries.clear()
+            self._tags.clear()
+
+    def stats(self):
+        """
+        Return a dictionary of counters for the cache
+        """
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'size_limit': self.size_limit,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+    def _forget(self, key, tags):
+        "Remove key from the tag index. Caller must hold the lock"
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys is None:
+                continue
+            keys.discard(key)
+            if not keys:
+                del self._tags[tag]
+
+
+def _config_int(option, default):
+    "Return an integer option from the trytond configuration"
+    return int(CONFIG.options.get(option, default) or 0)
+
+
+#: Cache of the pages rendered for guests by `blog.post.render`
+render_cache = LRUCache(
+    size_limit=_config_int('blog_render_cache_size', 1024),
+    ttl=_config_int('blog_render_cache_ttl', 300) or None,
+)
+
+#: Cache of the posts of `blog.post` resolved from their user and uri
+uri_cache = LRUCache(
+    size_limit=_config_int('blog_uri_cache_size', 10000),
+    ttl=_config_int('blog_uri_cache_ttl', 300) or None,
+)
+
+#: Cache of the Atom feeds generated by `blog.post`
+feed_cache = LRUCache(
+    size_limit=_config_int('blog_feed_cache_size', 1024),
+    ttl=_config_int('blog_feed_cache_ttl', 3600) or None,
+)
+
+#: Cache of the timestamps of the post lists of the users
+list_cache = LRUCache(
+    size_limit=_config_int('blog_list_cache_size', 10000),
+    ttl=_config_int('blog_list_cache_ttl', 300) or None,
+)
+
+#: Cache of the spam classifiers of the databases
+spam_cache = LRUCache(
+    size_limit=_config_int('blog_spam_cache_size', 16),
+    ttl=_config_int('blog_spam_cache_ttl', 600) or None,
+)
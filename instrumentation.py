@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+    instrumentation
+
+    Opt-in per request timing of the blog routes
+
+    Enabled with the `blog_instrumentation` option of the trytond
+    configuration. Every instrumented route then reports the number of
+    queries, the time spent in SQL, in rendering templates and in
+    serializing records in a `Server-Timing` header, and the figures are
+    aggregated per route for :func:`route_stats`.
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import time
+from contextlib import contextmanager
+from functools import wraps
+from threading import Lock, local
+
+import flask
+from trytond.config import CONFIG
+from trytond.transaction import Transaction
+import nereid
+from nereid.templating import LazyRenderer
+
+__all__ = [
+    'instrumented', 'timing', 'render_template', 'make_response',
+    'route_stats', 'QueryCounter', 'is_enabled',
+]
+
+_local = local()
+_stats = {}
+_stats_lock = Lock()
+
+
+def is_enabled():
+    "Return True if the instrumentation is turned on in the configuration"
+    return str(CONFIG.options.get('blog_instrumentation', '')).lower() in (
+        '1', 'true', 'yes', 'on'
+    )
+
+
+class QueryCounter(object):
+    """
+    Count and time the queries executed on the cursor of the current
+    transaction while the context manager is active
+    """
+
+    def __enter__(self):
+        self.cursor = Transaction().cursor
+        self.count = 0
+        self.duration = 0.0
+        # The execute of an outer counter, restored on exit
+        self.previous = vars(self.cursor).get('execute')
+        execute = self.cursor.execute
+
+        def counting_execute(*args, **kwargs):
+            begin = time.time()
+            try:
+                return execute(*args, **kwargs)
+            finally:
+                self.count += 1
+                self.duration += time.time() - begin
+        self.cursor.execute = counting_execute
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.previous is not None:
+            self.cursor.execute = self.previous
+        else:
+            del self.cursor.execute
+
+
+@contextmanager
+def timing(name):
+    """
+    Add the time spent in the block to the timer name of the instrumented
+    request being handled, if any
+    """
+    timers = getattr(_local, 'timers', None)
+    if timers is None:
+        yield
+        return
+    begin = time.time()
+    try:
+        yield
+    finally:
+        timers[name] = timers.get(name, 0.0) + time.time() - begin
+
+
+def make_response(rv):
+    """
+    flask.make_response, which also accepts the lazy renderers returned by
+    nereid.render_template. They are rendered the way the dispatcher of
+    nereid does, timed as template rendering.
+    """
+    if isinstance(rv, LazyRenderer):
+        with timing('template'):
+            rv = (unicode(rv), rv.status, rv.headers)
+    return flask.make_response(rv)
+
+
+def render_template(*args, **kwargs):
+    """
+    nereid.render_template, rendered right away into a response so that
+    the rendering is timed as template rendering
+    """
+    return make_response(nereid.render_template(*args, **kwargs))
+
+
+def instrumented(func):
+    """
+    Decorator for route handlers recording the figures of the request when
+    the instrumentation is enabled. Handlers called from another
+    instrumented handler are accounted to the outer one.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if getattr(_local, 'timers', None) is not None or not is_enabled():
+            return func(*args, **kwargs)
+
+        _local.timers = timers = {}
+        begin = time.time()
+        try:
+            with QueryCounter() as queries:
+                response = make_response(func(*args, **kwargs))
+        finally:
+            del _local.timers
+        total = time.time() - begin
+
+        figures = {
+            'total': total,
+            'sql': queries.duration,
+            'queries': queries.count,
+            'template': timers.get('template', 0.0),
+            'serialization': timers.get('serialization', 0.0),
+        }
+        _record(func.__name__, figures)
+        response.headers['Server-Timing'] = ', '.join([
+            'sql;dur=%.3f;desc="%d queries"' % (
+                figures['sql'] * 1000, figures['queries']
+            ),
+            'tpl;dur=%.3f' % (figures['template'] * 1000),
+            'ser;dur=%.3f' % (figures['serialization'] * 1000),
+            'total;dur=%.3f' % (figures['total'] * 1000),
+        ])
+        return response
+    return wrapper
+
+
+def _record(name, figures):
+    "Add the figures of a request to the aggregated statistics of name"
+    with _stats_lock:
+        stats = _stats.setdefault(name, {
+            'requests': 0, 'queries': 0, 'max_ms': 0.0, 'total_ms': 0.0,
+            'sql_ms': 0.0, 'template_ms': 0.0, 'serialization_ms': 0.0,
+        })
+        stats['requests'] += 1
+        stats['queries'] += figures['queries']
+        stats['max_ms'] = max(stats['max_ms'], figures['total'] * 1000)
+        for key in ('total', 'sql', 'template', 'serialization'):
+            stats[key + '_ms'] += figures[key] * 1000
+
+
+def route_stats():
+    """
+    Return the statistics aggregated per route since the process started
+    """
+    with _stats_lock:
+        result = {}
+        for name, stats in _stats.iteritems():
+            result[name] = dict(stats)
+            requests = stats['requests']
+            for key in (
+                    'queries', 'total_ms', 'sql_ms', 'template_ms',
+                    'serialization_ms'):
+                result[name]['mean_' + key] = float(stats[key]) / requests
+        return result
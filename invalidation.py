@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+"""
+    invalidation
+
+    Propagation of the invalidations of the process local caches to the
+    other worker processes
+
+    The bus is chosen with the `blog_invalidation_bus` option of the trytond
+    configuration:
+
+    * empty (the default): no propagation, for single process deployments
+    * `sqlite:////path/to/file.db`: a sqlite file shared by the processes of
+      a host
+    * `redis://host:port/db`: a Redis server shared by all the hosts,
+      requires the redis package
+
+    Every invalidation is applied to the caches of the current process and
+    published on the bus. The other processes apply the invalidations
+    published since their last poll before reading from their caches, see
+    :func:`consume`.
+
+    Invalidations made in a transaction are only published, and applied
+    again to the caches of the current process, once it is committed, see
+    :func:`flush`. Until then the other transactions still read the rows as
+    they were and would cache them again, to be served until the entries
+    expire.
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import sqlite3
+import time
+import uuid
+from threading import Lock
+
+import simplejson as json
+from trytond.config import CONFIG
+from trytond.transaction import Transaction
+
+from cache import render_cache, uri_cache, feed_cache, list_cache, \
+    spam_cache
+
+__all__ = [
+    'InvalidationBus', 'SQLiteBus', 'RedisBus', 'get_bus',
+    'invalidate', 'clear', 'consume', 'flush',
+]
+
+#: Tag published to clear the caches entirely
+CLEAR = '*'
+
+#: Caches kept consistent through the bus
+CACHES = (render_cache, uri_cache, feed_cache, list_cache, spam_cache)
+
+_bus = None
+_bus_lock = Lock()
+
+
+class InvalidationBus(object):
+    """
+    Base class of the buses. This one does not propagate anything and is
+    used when no bus is configured.
+
+    Every bus instance has a unique origin so that a process does not
+    apply its own invalidations twice.
+    """
+
+    def __init__(self):
+        self.origin = uuid.uuid4().hex
+
+    def publish(self, tags):
+        "Send the tags to the other processes"
+        pass
+
+    def poll(self):
+        "Return the tags published by the other processes since last poll"
+        return []
+
+    @staticmethod
+    def encode(tags):
+        return json.dumps([
+            tag if tag == CLEAR else list(tag) for tag in tags
+        ])
+
+    @staticmethod
+    def decode(data):
+        return [
+            tag if tag == CLEAR else tuple(tag) for tag in json.loads(data)
+        ]
+
+
+class SQLiteBus(InvalidationBus):
+    """
+    Bus storing the invalidations in a sqlite file shared by the processes
+    of a host. Events older than `retention` seconds are pruned.
+    """
+
+    def __init__(self, path, retention=3600):
+        super(SQLiteBus, self).__init__()
+        self.path = path
+        self.retention = retention
+        self._lock = Lock()
+        self._connection = sqlite3.connect(
+            path, timeout=10, check_same_thread=False
+        )
+        with self._lock:
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS blog_invalidation ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, origin TEXT, '
+                'tags TEXT, created REAL)'
+            )
+            self._connection.commit()
+            # Only the events published from now on are of interest
+            self._last_id, = self._connection.execute(
+                'SELECT COALESCE(MAX(id), 0) FROM blog_invalidation'
+            ).fetchone()
+
+    def publish(self, tags):
+        with self._lock:
+            now = time.time()
+            self._connection.execute(
+                'INSERT INTO blog_invalidation (origin, tags, created) '
+                'VALUES (?, ?, ?)', (self.origin, self.encode(tags), now)
+            )
+            self._connection.execute(
+                'DELETE FROM blog_invalidation WHERE created < ?',
+                (now - self.retention,)
+            )
+            self._connection.commit()
+
+    def poll(self):
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT id, origin, tags FROM blog_invalidation '
+                'WHERE id > ? ORDER BY id', (self._last_id,)
+            ).fetchall()
+        tags = []
+        for event_id, origin, data in rows:
+            self._last_id = event_id
+            if origin != self.origin:
+                tags.extend(self.decode(data))
+        return tags
+
+
+class RedisBus(InvalidationBus):
+    """
+    Bus publishing the invalidations on a Redis channel
+    """
+
+    def __init__(self, url, channel='nereid_blog.invalidation'):
+        import redis
+
+        super(RedisBus, self).__init__()
+        self.channel = channel
+        self._lock = Lock()
+        self._client = redis.StrictRedis.from_url(url)
+        self._pubsub = self._client.pubsub(ignore_subscribe_messages=True)
+        self._pubsub.subscribe(channel)
+
+    def publish(self, tags):
+        self._client.publish(self.channel, json.dumps({
+            'origin': self.origin,
+            'tags': self.encode(tags),
+        }))
+
+    def poll(self):
+        tags = []
+        with self._lock:
+            while True:
+                message = self._pubsub.get_message()
+                if message is None:
+                    break
+                event = json.loads(message['data'])
+                if event['origin'] != self.origin:
+                    tags.extend(self.decode(event['tags']))
+        return tags
+
+
+def get_bus():
+    "Return the bus of the process, created from the configuration"
+    global _bus
+    with _bus_lock:
+        if _bus is None or getattr(_bus, 'pid', None) != os.getpid():
+            # Buses are not shared with the processes forked from this one
+            url = CONFIG.options.get('blog_invalidation_bus') or ''
+            if url.startswith('sqlite://'):
+                _bus = SQLiteBus(url[len('sqlite://'):])
+            elif url.startswith('redis://'):
+                _bus = RedisBus(url)
+            elif url:
+                raise ValueError('Invalid blog_invalidation_bus: %s' % url)
+            else:
+                _bus = InvalidationBus()
+            _bus.pid = os.getpid()
+        return _bus
+
+
+def _apply(tags):
+    "Invalidate the tags in the caches of this process"
+    for cache in CACHES:
+        if CLEAR in tags:
+            cache.clear()
+        else:
+            cache.invalidate(*tags)
+
+
+def _pending():
+    """
+    Return the list of the tags waiting for the commit of the current
+    transaction, or None outside of a transaction.
+
+    The list is kept on the cursor, whose commit is wrapped to flush it
+    and whose rollback is wrapped to drop it.
+    """
+    cursor = Transaction().cursor
+    if cursor is None:
+        return None
+    pending = vars(cursor).get('blog_invalidations')
+    if pending is None:
+        pending = cursor.blog_invalidations = []
+        commit, rollback = cursor.commit, cursor.rollback
+
+        def flushing_commit(*args, **kwargs):
+            result = commit(*args, **kwargs)
+            _publish(pending)
+            return result
+
+        def discarding_rollback(*args, **kwargs):
+            result = rollback(*args, **kwargs)
+            # Entries cached from the rows rolled back are dropped too
+            _apply(pending[:])
+            del pending[:]
+            return result
+        cursor.commit = flushing_commit
+        cursor.rollback = discarding_rollback
+    return pending
+
+
+def invalidate(*tags):
+    """
+    Drop the entries with the tags from the caches of every process. In a
+    transaction, the tags are published once it is committed.
+    """
+    if not tags:
+        return
+    _apply(tags)
+    pending = _pending()
+    if pending is None:
+        get_bus().publish(tags)
+    else:
+        pending.extend(tags)
+
+
+def clear():
+    "Drop all the entries from the caches of every process"
+    invalidate(CLEAR)
+
+
+def flush():
+    """
+    Publish the invalidations made in the current transaction and apply
+    them again to the caches of this process, dropping the entries other
+    transactions cached before the commit. Called once the transaction is
+    committed.
+    """
+    pending = _pending()
+    if pending:
+        _publish(pending)
+
+
+def _publish(pending):
+    "Apply and publish the pending tags, once each, and empty the list"
+    tags, seen = [], set()
+    for tag in pending:
+        if tag not in seen:
+            seen.add(tag)
+            tags.append(tag)
+    del pending[:]
+    if tags:
+        _apply(tags)
+        get_bus().publish(tags)
+
+
+def consume():
+    """
+    Apply the invalidations published by the other processes. To be called
+    before reading from the caches.
+    """
+    tags = get_bus().poll()
+    if tags:
+        _apply(tags)
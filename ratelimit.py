@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""
+    ratelimit
+
+    Token bucket rate limiting of the blog routes creating records
+
+    A limit is set for a name with the `blog_rate_limit_<name>` option of
+    the trytond configuration, as `count/seconds`: every user (or address
+    for guests) may then make count requests in a burst, and one more every
+    seconds / count seconds. The routes use the `comment` and `post` names.
+
+    Buckets are kept in the process by default. With the
+    `blog_rate_limit_storage` option set to `sqlite:////path/to/file.db`
+    they are kept in a sqlite file shared by the processes of a host.
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import sqlite3
+import time
+from functools import wraps
+from threading import Lock
+
+from flask import current_app
+from trytond.config import CONFIG
+from trytond.transaction import Transaction
+from nereid import request, jsonify, current_user
+
+from cache import LRUCache
+
+__all__ = [
+    'MemoryStorage', 'SQLiteStorage', 'get_storage', 'get_limit', 'check',
+    'rate_limited', 'stats',
+]
+
+_storage = None
+_storage_lock = Lock()
+_stats = {}
+_stats_lock = Lock()
+
+
+class MemoryStorage(object):
+    """
+    Buckets of the process. The least recently used buckets are dropped
+    beyond size_limit keys, which only gives them a full bucket again.
+    """
+
+    def __init__(self, size_limit=100000):
+        self._lock = Lock()
+        self._buckets = LRUCache(size_limit=size_limit)
+
+    def consume(self, key, capacity, rate, now):
+        """
+        Take a token from the bucket of key, refilled at rate tokens per
+        second up to capacity. Return a (allowed, retry_after) tuple where
+        retry_after is the number of seconds until a token is available.
+        """
+        with self._lock:
+            tokens, updated = self._buckets.get(key) or (capacity, now)
+            tokens, retry_after = _take(tokens, updated, capacity, rate, now)
+            self._buckets.set(key, (max(tokens, 0), now))
+        return retry_after == 0, retry_after
+
+
+class SQLiteStorage(object):
+    """
+    Buckets kept in a sqlite file shared by the processes of a host.
+    Buckets untouched for a day are pruned.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = Lock()
+        self._calls = 0
+        self._connection = sqlite3.connect(
+            path, timeout=10, check_same_thread=False, isolation_level=None
+        )
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS blog_rate_limit ('
+            'key TEXT PRIMARY KEY, tokens REAL, updated REAL)'
+        )
+
+    def consume(self, key, capacity, rate, now):
+        "See :meth:`MemoryStorage.consume`"
+        key = repr(key)
+        with self._lock:
+            execute = self._connection.execute
+            # Taking the write lock first makes the read and the update of
+            # the bucket atomic for all the processes
+            execute('BEGIN IMMEDIATE')
+            try:
+                row = execute(
+                    'SELECT tokens, updated FROM blog_rate_limit '
+                    'WHERE key = ?', (key,)
+                ).fetchone()
+                tokens, updated = row or (capacity, now)
+                tokens, retry_after = _take(
+                    tokens, updated, capacity, rate, now
+                )
+                execute(
+                    'INSERT OR REPLACE INTO blog_rate_limit '
+                    '(key, tokens, updated) VALUES (?, ?, ?)',
+                    (key, max(tokens, 0), now)
+                )
+                self._calls += 1
+                if self._calls % 1000 == 0:
+                    execute(
+                        'DELETE FROM blog_rate_limit WHERE updated < ?',
+                        (now - 86400,)
+                    )
+                execute('COMMIT')
+            except Exception:
+                execute('ROLLBACK')
+                raise
+        return retry_after == 0, retry_after
+
+
+def _take(tokens, updated, capacity, rate, now):
+    """
+    Return the tokens left once the bucket is refilled and a token taken,
+    and the seconds to wait for a token if there was none to take
+    """
+    tokens = min(capacity, tokens + (now - updated) * rate)
+    if tokens >= 1:
+        return tokens - 1, 0
+    return tokens, (1 - tokens) / rate
+
+
+def get_storage():
+    "Return the bucket storage of the process, created from the config"
+    global _storage
+    with _storage_lock:
+        if _storage is None or getattr(_storage, 'pid', None) != os.getpid():
+            url = CONFIG.options.get('blog_rate_limit_storage') or ''
+            if url.startswith('sqlite://'):
+                _storage = SQLiteStorage(url[len('sqlite://'):])
+            elif url:
+                raise ValueError('Invalid blog_rate_limit_storage: %s' % url)
+            else:
+                _storage = MemoryStorage()
+            _storage.pid = os.getpid()
+        return _storage
+
+
+def get_limit(name):
+    """
+    Return the (capacity, rate) of the limit name from the configuration,
+    or None if requests are not limited
+    """
+    value = CONFIG.options.get('blog_rate_limit_%s' % name)
+    if not value:
+        return None
+    try:
+        count, seconds = map(float, str(value).split('/'))
+    except ValueError:
+        raise ValueError('Invalid blog_rate_limit_%s: %s' % (name, value))
+    return count, count / seconds
+
+
+def check(name, key):
+    """
+    Take a token from the bucket of key for the limit name in the current
+    database. Return a (allowed, retry_after) tuple.
+    """
+    limit = get_limit(name)
+    if limit is None:
+        return True, 0
+    allowed, retry_after = get_storage().consume(
+        (name, Transaction().cursor.database_name, key),
+        limit[0], limit[1], time.time()
+    )
+    with _stats_lock:
+        counters = _stats.setdefault(name, {'allowed': 0, 'limited': 0})
+        counters['allowed' if allowed else 'limited'] += 1
+    return allowed, retry_after
+
+
+def rate_limited(name):
+    """
+    Decorator for route handlers limiting their POST requests with the
+    limit name, per logged in user or per address for guests. Excess
+    requests are answered with a 429 before the handler runs.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if request.method != 'POST':
+                return func(*args, **kwargs)
+            if current_user.is_anonymous():
+                key = request.remote_addr
+            else:
+                key = current_user.id
+            allowed, retry_after = check(name, key)
+            if allowed:
+                return func(*args, **kwargs)
+
+            if request.is_xhr:
+                rv = jsonify(success=False, errors=['Too many requests'])
+            else:
+                rv = current_app.response_class('Too many requests')
+            rv.status_code = 429
+            rv.headers['Retry-After'] = str(int(retry_after) + 1)
+            return rv
+        return wrapper
+    return decorator
+
+
+def stats():
+    "Return the number of allowed and limited requests per limit"
+    with _stats_lock:
+        return dict((name, dict(c)) for name, c in _stats.iteritems())
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+    search
+
+    Full text search over the title and content of the published posts
+
+    On PostgreSQL the posts are matched against a GIN index on their
+    tsvector and ranked with ts_rank. On sqlite, used by the tests, an FTS4
+    table is kept in sync with the posts instead and results are ordered
+    by post date. Other backends have no search, see
+    :func:`search_available`.
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import re
+
+from trytond.config import CONFIG
+from trytond.transaction import Transaction
+
+__all__ = [
+    'register_search_index', 'index_posts', 'unindex_posts', 'search_posts',
+    'search_available',
+]
+
+INDEX_NAME = 'blog_post_search_index'
+FTS_TABLE = 'blog_post_fts'
+#: Backends on which the posts can be searched
+BACKENDS = ('postgresql', 'sqlite')
+
+
+def _language():
+    "Return the text search configuration used on PostgreSQL"
+    language = CONFIG.options.get('blog_search_config') or 'english'
+    if not re.match(r'^\w+$', language):
+        raise ValueError('Invalid blog_search_config: %s' % language)
+    return language
+
+
+def _document():
+    """
+    Return the tsvector expression indexed for a post. Queries must use
+    the very same expression for the index to be used.
+    """
+    return (
+        "TO_TSVECTOR('%s', COALESCE(\"title\", '') || ' ' || "
+        "COALESCE(\"content\", ''))"
+    ) % _language()
+
+
+def search_available():
+    "Return True if the posts can be searched on the current backend"
+    return CONFIG['db_type'] in BACKENDS
+
+
+def register_search_index(table_name):
+    """
+    Create the full text index of the posts in table_name if it does not
+    exist yet
+    """
+    cursor = Transaction().cursor
+    backend_name = CONFIG['db_type']
+
+    if backend_name == 'postgresql':
+        cursor.execute(
+            'SELECT 1 FROM pg_indexes WHERE indexname = %s', (INDEX_NAME,)
+        )
+        if not cursor.fetchone():
+            cursor.execute('CREATE INDEX "%s" ON "%s" USING GIN ((%s))' % (
+                INDEX_NAME, table_name, _document()
+            ))
+    elif backend_name == 'sqlite':
+        cursor.execute(
+            'SELECT 1 FROM sqlite_master WHERE type = \'table\' '
+            'AND name = ?', (FTS_TABLE,)
+        )
+        if not cursor.fetchone():
+            cursor.execute(
+                'CREATE VIRTUAL TABLE "%s" USING fts4(title, content)'
+                % FTS_TABLE
+            )
+            cursor.execute(
+                'INSERT INTO "%s" (docid, title, content) '
+                'SELECT id, title, content FROM "%s"' % (FTS_TABLE, table_name)
+            )
+
+
+def index_posts(table_name, post_ids):
+    """
+    Update the full text index for the posts. PostgreSQL maintains its
+    index by itself so only the sqlite table needs to be updated.
+    """
+    if CONFIG['db_type'] != 'sqlite' or not post_ids:
+        return
+    cursor = Transaction().cursor
+    unindex_posts(post_ids)
+    for i in range(0, len(post_ids), cursor.IN_MAX):
+        cursor.execute(
+            'INSERT INTO "%s" (docid, title, content) '
+            'SELECT id, title, content FROM "%s" WHERE id IN (%s)' % (
+                FTS_TABLE, table_name,
+                ', '.join(map(str, map(int, post_ids[i:i + cursor.IN_MAX])))
+            )
+        )
+
+
+def unindex_posts(post_ids):
+    "Remove the posts from the full text index"
+    if CONFIG['db_type'] != 'sqlite' or not post_ids:
+        return
+    cursor = Transaction().cursor
+    for i in range(0, len(post_ids), cursor.IN_MAX):
+        cursor.execute('DELETE FROM "%s" WHERE docid IN (%s)' % (
+            FTS_TABLE,
+            ', '.join(map(str, map(int, post_ids[i:i + cursor.IN_MAX])))
+        ))
+
+
+def search_posts(table_name, text, offset=0, limit=None):
+    """
+    Return the ids of the published posts matching text, best matches
+    first. Raises NotImplementedError on the backends without full text
+    search, see :func:`search_available`.
+    """
+    cursor = Transaction().cursor
+    backend_name = CONFIG['db_type']
+
+    if backend_name == 'postgresql':
+        document = _document()
+        query = (
+            'SELECT "id" FROM "%(table)s" '
+            'WHERE "state" = \'Published\' '
+            'AND %(document)s @@ PLAINTO_TSQUERY(\'%(language)s\', %%s) '
+            'ORDER BY TS_RANK(%(document)s, '
+                'PLAINTO_TSQUERY(\'%(language)s\', %%s)) DESC, '
+            '"post_date" DESC, "id" DESC '
+            'LIMIT %%s OFFSET %%s'
+        ) % {
+            'table': table_name,
+            'document': document,
+            'language': _language(),
+        }
+        cursor.execute(query, (text, text, limit, offset))
+    elif backend_name == 'sqlite':
+        # Only keep the words so that the text can not be taken for the
+        # query syntax of FTS
+        words = re.findall(r'\w+', text, re.UNICODE)
+        if not words:
+            return []
+        cursor.execute(
+            'SELECT p.id FROM "%(table)s" AS p '
+            'JOIN "%(fts)s" ON "%(fts)s".docid = p.id '
+            'WHERE "%(fts)s" MATCH ? AND p.state = \'Published\' '
+            'ORDER BY p.post_date DESC, p.id DESC '
+            'LIMIT ? OFFSET ?' % {'table': table_name, 'fts': FTS_TABLE}, (
+                ' '.join('"%s"' % word for word in words),
+                -1 if limit is None else limit, offset,
+            )
+        )
+    else:
+        raise NotImplementedError(
+            'Full text search is not available on %s' % backend_name
+        )
+    return [row[0] for row in cursor.fetchall()]
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""
+    spam
+
+    Naive Bayes spam classifier of the comments
+
+    The words of a comment (and of the name of its author) are hashed into
+    a fixed number of buckets, and the classifier keeps, for every bucket,
+    the number of spam and legitimate comments which had a word in it. The
+    counts are stored in `blog.spam.token` and trained from the decisions
+    of the post owners.
+
+    Each process keeps the counts of a database in memory, so scoring a
+    comment does not query the database. A training updates the counts in
+    memory along with the database, rather than dropping them, and the
+    other processes reload the counts once they are older than
+    `blog_spam_cache_ttl` seconds (600 by default). This spares them a
+    reload of the whole table on every decision of a moderation session.
+
+    The classifier only gives its opinion once it has been trained with
+    `blog_spam_min_documents` (10 by default) comments of each kind. A
+    comment is spam if its probability of being one exceeds
+    `blog_spam_threshold` (0.9 by default).
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import math
+import re
+import zlib
+
+from trytond.config import CONFIG
+from trytond.model import ModelSQL, fields
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+from cache import spam_cache
+import invalidation
+
+__all__ = [
+    'SpamToken', 'NaiveBayes', 'tokenize', 'get_classifier', 'train',
+    'classify',
+]
+
+#: Number of buckets words are hashed into, a power of two
+BUCKETS = 2 ** 18
+#: Bucket holding the number of documents trained
+DOCUMENTS = -1
+
+
+def tokenize(content, name=None):
+    "Return the set of buckets of the words of a comment"
+    words = re.findall(r'\w+', (content or '').lower(), re.UNICODE)
+    if name:
+        words += [
+            u'name:' + word
+            for word in re.findall(r'\w+', name.lower(), re.UNICODE)
+        ]
+    return set(
+        zlib.crc32(word.encode('utf-8')) & (BUCKETS - 1) for word in words
+    )
+
+
+class SpamToken(ModelSQL):
+    'Blog Spam Token'
+    __name__ = 'blog.spam.token'
+
+    bucket = fields.Integer('Bucket', required=True, select=True)
+    spam = fields.Integer('Spam', required=True)
+    ham = fields.Integer('Ham', required=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(SpamToken, cls).__setup__()
+        cls._sql_constraints += [
+            ('bucket_uniq', 'UNIQUE(bucket)', 'Buckets must be unique'),
+        ]
+
+    @classmethod
+    def add(cls, deltas):
+        """
+        Add the deltas, a dictionary of bucket to (spam, ham) increments,
+        to the counts of the buckets.
+
+        The existing buckets are updated IN_MAX at a time with one query
+        for all the buckets sharing the same increments, and the new ones
+        are inserted with a single create, so training many documents at
+        once costs about as many queries as training one.
+        """
+        table = cls.__table__()
+        cursor = Transaction().cursor
+
+        buckets = sorted(b for b, delta in deltas.iteritems() if any(delta))
+        existing = set()
+        for i in range(0, len(buckets), cursor.IN_MAX):
+            cursor.execute(*table.select(
+                table.bucket,
+                where=table.bucket.in_(buckets[i:i + cursor.IN_MAX])
+            ))
+            existing.update(row[0] for row in cursor.fetchall())
+
+        by_delta = {}
+        for bucket in sorted(existing):
+            by_delta.setdefault(deltas[bucket], []).append(bucket)
+        for (spam, ham), sub_buckets in by_delta.iteritems():
+            for i in range(0, len(sub_buckets), cursor.IN_MAX):
+                cursor.execute(*table.update(
+                    [table.spam, table.ham],
+                    [table.spam + spam, table.ham + ham],
+                    where=table.bucket.in_(sub_buckets[i:i + cursor.IN_MAX])
+                ))
+        missing = [b for b in buckets if b not in existing]
+        if missing:
+            cls.create([{
+                'bucket': bucket,
+                'spam': max(deltas[bucket][0], 0),
+                'ham': max(deltas[bucket][1], 0),
+            } for bucket in missing])
+
+    @classmethod
+    def load(cls):
+        "Return a dictionary of bucket to (spam, ham) counts"
+        table = cls.__table__()
+        cursor = Transaction().cursor
+        cursor.execute(*table.select(table.bucket, table.spam, table.ham))
+        return dict(
+            (bucket, (spam, ham)) for bucket, spam, ham in cursor.fetchall()
+        )
+
+
+class NaiveBayes(object):
+    """
+    Classifier computing the probability that a comment is spam from the
+    counts of its buckets, with Laplace smoothing
+    """
+
+    def __init__(self, counts):
+        self.counts = counts
+        self.spam_documents, self.ham_documents = counts.get(
+            DOCUMENTS, (0, 0)
+        )
+
+    def update(self, deltas):
+        """
+        Add the deltas, a dictionary of bucket to (spam, ham) increments,
+        to the counts
+        """
+        for bucket, (spam, ham) in deltas.iteritems():
+            old_spam, old_ham = self.counts.get(bucket, (0, 0))
+            self.counts[bucket] = (old_spam + spam, old_ham + ham)
+        self.spam_documents, self.ham_documents = self.counts.get(
+            DOCUMENTS, (0, 0)
+        )
+
+    def is_trained(self, min_documents):
+        return min(self.spam_documents, self.ham_documents) >= min_documents
+
+    def score(self, buckets):
+        "Return the probability that the document with the buckets is spam"
+        log_odds = math.log(
+            float(self.spam_documents + 1) / (self.ham_documents + 1)
+        )
+        for bucket in buckets:
+            spam, ham = self.counts.get(bucket, (0, 0))
+            log_odds += math.log(
+                float(spam + 1) / (self.spam_documents + 2)
+            ) - math.log(
+                float(ham + 1) / (self.ham_documents + 2)
+            )
+        if log_odds < -700:
+            return 0.0
+        return 1.0 / (1.0 + math.exp(-min(log_odds, 700)))
+
+
+def _tag():
+    return ('blog.spam', Transaction().cursor.database_name)
+
+
+def get_classifier():
+    "Return the classifier of the current database"
+    tag = _tag()
+    invalidation.consume()
+    classifier = spam_cache.get(tag)
+    if classifier is None:
+        SpamToken = Pool().get('blog.spam.token')
+        classifier = NaiveBayes(SpamToken.load())
+        spam_cache.set(tag, classifier, tags=[tag])
+    return classifier
+
+
+def train(comments, is_spam, moved=None):
+    """
+    Train the classifier with comments of the given kind, as a list of
+    (content, name) tuples. The increments of all the comments are summed
+    up before being stored, see :meth:`SpamToken.add`.
+
+    :param moved: comments, as (content, name) tuples too, the classifier
+                  was trained with as the other kind. They are taken back
+                  from the other kind and counted as this one.
+    """
+    SpamToken = Pool().get('blog.spam.token')
+    deltas = {}
+    for documents, taken in ((comments, 0), (moved or [], -1)):
+        for content, name in documents:
+            for bucket in tokenize(content, name) | set([DOCUMENTS]):
+                spam, ham = deltas.get(bucket, (0, 0))
+                if is_spam:
+                    deltas[bucket] = (spam + 1, ham + taken)
+                else:
+                    deltas[bucket] = (spam + taken, ham + 1)
+    if not deltas:
+        return
+    SpamToken.add(deltas)
+
+    # The counts in memory follow the training, the other processes
+    # reload theirs when they expire
+    classifier = spam_cache.get(_tag())
+    if classifier is not None:
+        classifier.update(deltas)
+
+
+def classify(content, name=None):
+    """
+    Return True if the comment is spam, False if it is not, or None if the
+    classifier is not trained enough to tell
+    """
+    classifier = get_classifier()
+    min_documents = int(CONFIG.options.get('blog_spam_min_documents') or 10)
+    if not classifier.is_trained(min_documents):
+        return None
+    threshold = float(CONFIG.options.get('blog_spam_threshold') or 0.9)
+    return classifier.score(tokenize(content, name)) > threshold
@@ -14,12 +14,20 @@ if os.path.isdir(DIR):
     sys.path.insert(0, os.path.dirname(DIR))
 
 import unittest
+import tempfile
+from datetime import datetime
+
 import simplejson as json
 import trytond.tests.test_tryton
 from trytond.tests.test_tryton import test_view, test_depends, \
     POOL, USER, DB_NAME, CONTEXT
 from nereid.testing import NereidTestCase
+from trytond.config import CONFIG
 from trytond.transaction import Transaction
+from trytond.modules.nereid_blog.cache import render_cache, uri_cache, \
+    feed_cache, list_cache
+from trytond.modules.nereid_blog import invalidation, ratelimit, spam, \
+    instrumentation
 
 
 class TestNereidBlog(NereidTestCase):
@@ -41,6 +49,10 @@ class TestNereidBlog(NereidTestCase):
         self.BlogPost = POOL.get('blog.post')
         self.BlogPostComment = POOL.get('blog.post.comment')
 
+        # The records cached by a test are rolled back with its transaction
+        for cache in invalidation.CACHES:
+            cache.clear()
+
         self.templates = {
             'localhost/blog_post_form.jinja':
             '{{ form.errors }} {{ get_flashed_messages() }}',
@@ -50,6 +62,8 @@ class TestNereidBlog(NereidTestCase):
             'localhost/my_blog_posts.jinja': '{{ posts|count }}',
             'localhost/blog_post_edit.jinja':
             '{{ form.errors }} {{ get_flashed_messages() }}',
+            'localhost/blog_post_search.jinja': '{{ posts|count }}',
+            'localhost/blog_posts_latest.jinja': '{{ posts|count }}',
         }
 
     def get_template_source(self, name):
@@ -252,25 +266,47 @@ class TestNereidBlog(NereidTestCase):
                 self.BlogPost.publish([post])
                 self.assertEqual(post.state, 'Published')
 
-                # Create a new blog with same URI
+                # Create a new blog with the same title, its URI gets a suffix
                 rv = c.post('/post/-new', data={
                     'title': 'This is a blog post',
                     'content': 'Some test content',
                 })
-                self.assertEqual(rv.status_code, 200)
-                posts = self.BlogPost.search([])
+                self.assertEqual(rv.status_code, 302)
+                posts = self.BlogPost.search([
+                    ('uri', '=', 'this-is-a-blog-post-2'),
+                ])
                 self.assertEqual(len(posts), 1)
 
-                # Create a new blog with different URI
+                # Create a new blog with an existing URI given explicitly
                 rv = c.post('/post/-new', data={
                     'title': 'This is a blog post',
                     'uri': 'this-is-a-blog-post-2',
                     'content': 'Some test content',
                 })
-                self.assertEqual(rv.status_code, 302)
+                self.assertEqual(rv.status_code, 200)
                 posts = self.BlogPost.search([])
                 self.assertEqual(len(posts), 2)
 
+                # The next suffix follows the highest one
+                self.BlogPost.create([{
+                    'title': 'This is a blog post',
+                    'uri': 'this-is-a-blog-post-7',
+                    'content': 'Some test content',
+                    'nereid_user': self.registered_user.id,
+                }])
+                self.assertEqual(
+                    self.BlogPost.get_free_uri(
+                        self.registered_user.id, 'this-is-a-blog-post'
+                    ), 'this-is-a-blog-post-8'
+                )
+                # URIs are unique per user
+                self.assertFalse(self.BlogPost.uri_exists(
+                    self.registered_user2.id, 'this-is-a-blog-post'
+                ))
+                self.BlogPost.delete(self.BlogPost.search([
+                    ('uri', '=', 'this-is-a-blog-post-7'),
+                ]))
+
                 # Get the list of Blogs
                 rv = c.get('/posts/%s/1' % self.registered_user.id)
                 self.assertEqual(rv.status_code, 200)
@@ -449,6 +485,8 @@ class TestNereidBlog(NereidTestCase):
                 self.assertFalse(comment.is_spam)
                 post = posts[0]
                 self.assertEqual(len(post.published_comments), 1)
+                self.assertEqual(post.published_comment_count, 1)
+                self.assertEqual(post.comment_count, 1)
 
                 # try to modify the comment as not the owner of post
                 rv = c.post('/comment/%s/-spam' % comment.id, data={
@@ -471,6 +509,1077 @@ class TestNereidBlog(NereidTestCase):
                 self.assertTrue(comment.is_spam)
                 post = posts[0]
                 self.assertEqual(len(post.published_comments), 0)
+                self.assertEqual(post.published_comment_count, 0)
+                self.assertEqual(post.comment_count, 1)
+
+    def test_0060_render_cache_for_guests(self):
+        "Published posts viewed by guests are served from the render cache"
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+            render_cache.clear()
+
+            post, = self.BlogPost.create([{
+                'title': 'This is a blog post',
+                'uri': 'this-is-a-blog-post',
+                'content': 'Some test content',
+                'nereid_user': self.registered_user.id,
+            }])
+            url = '/post/%s/%s' % (
+                self.registered_user.id, 'this-is-a-blog-post'
+            )
+
+            with app.test_client() as c:
+                # Drafts are never cached
+                rv = c.get(url)
+                self.assertEqual(rv.status_code, 403)
+                self.assertEqual(len(render_cache), 0)
+
+                self.BlogPost.publish([post])
+                hits = render_cache.hits
+                rv = c.get(url)
+                self.assertEqual(rv.status_code, 200)
+                self.assertEqual(len(render_cache), 1)
+
+                rv = c.get(url)
+                self.assertEqual(rv.status_code, 200)
+                self.assertTrue('Some test content' in rv.data)
+                self.assertEqual(render_cache.hits, hits + 1)
+                # Pages are cached per website, whose templates they use
+                key, = render_cache._entries
+                website, = self.Website.search([])
+                self.assertEqual(key[4], website.id)
+
+                # Writing a comment drops the cached page
+                self.BlogPostComment.create([{
+                    'post': post.id,
+                    'name': 'John Doe',
+                    'content': 'This is an awesome post',
+                }])
+                self.assertEqual(len(render_cache), 0)
+
+                # Logged in users always get a freshly rendered page
+                c.post('/login', data={
+                    'email': 'email@example.com',
+                    'password': 'password',
+                })
+                c.get(url)
+                c.get(url)
+                self.assertEqual(len(render_cache), 0)
+
+    def test_0070_cursor_pagination(self):
+        "Paginate the posts of a user with a cursor"
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            self.BlogPost.create([{
+                'title': 'Post %d' % i,
+                'uri': 'post-%d' % i,
+                'content': 'Some test content',
+                'nereid_user': self.registered_user.id,
+                'state': 'Published',
+                # Two posts share each post date to exercise the tie break
+                'post_date': datetime(2014, 1, 1 + i // 2),
+            } for i in range(12)])
+            self.BlogPost.create([{
+                'title': 'Draft %d' % i,
+                'uri': 'draft-%d' % i,
+                'content': 'Some test content',
+                'nereid_user': self.registered_user.id,
+            } for i in range(3)])
+
+            headers = [('X-Requested-With', 'XMLHttpRequest')]
+            with app.test_client() as c:
+                rv = c.get(
+                    '/posts/%d?after=' % self.registered_user.id,
+                    headers=headers
+                )
+                page1 = json.loads(rv.data)
+                self.assertEqual(len(page1['items']), 10)
+                self.assertTrue(page1['has_next'])
+                self.assertEqual(page1['items'][0]['uri'], 'post-11')
+
+                rv = c.get(
+                    '/posts/%d?after=%s' % (
+                        self.registered_user.id, page1['next_cursor']
+                    ), headers=headers
+                )
+                page2 = json.loads(rv.data)
+                self.assertEqual(
+                    [item['uri'] for item in page2['items']],
+                    ['post-1', 'post-0']
+                )
+                self.assertFalse(page2['has_next'])
+                self.assertEqual(page2['next_cursor'], None)
+
+                rv = c.get(
+                    '/posts/%d?after=invalid' % self.registered_user.id
+                )
+                self.assertEqual(rv.status_code, 400)
+
+                # My posts list the drafts first
+                c.post('/login', data={
+                    'email': 'email@example.com',
+                    'password': 'password',
+                })
+                uris, after = [], ''
+                while after is not None:
+                    rv = c.get('/posts/-my?after=%s' % after, headers=headers)
+                    data = json.loads(rv.data)
+                    uris.extend(item['uri'] for item in data['items'])
+                    after = data['next_cursor']
+                self.assertEqual(len(uris), 15)
+                self.assertEqual(uris[:3], ['draft-2', 'draft-1', 'draft-0'])
+                self.assertEqual(uris[-1], 'post-0')
+
+            posts = self.BlogPost.search([])
+            for purpose in (None, 'activity_stream', 'list'):
+                self.assertEqual(
+                    self.BlogPost.serialize_many(posts, purpose),
+                    [post.serialize(purpose) for post in posts]
+                )
+
+    def test_0080_paginate_and_stream_comments(self):
+        "Fetch the comments of a post by pages and as a stream"
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            post, = self.BlogPost.create([{
+                'title': 'This is a blog post',
+                'uri': 'this-is-a-blog-post',
+                'content': 'Some test content',
+                'nereid_user': self.registered_user.id,
+                'state': 'Published',
+                'comments': [('create', [{
+                    'name': 'John Doe',
+                    'content': 'Comment %d' % i,
+                    'is_spam': i % 5 == 0,
+                } for i in range(10)])],
+            }])
+
+            with app.test_client() as c:
+                # Guests do not get the spam
+                rv = c.get('/post/%d/-comment' % post.id)
+                self.assertEqual(len(json.loads(rv.data)['comments']), 8)
+
+                rv = c.get('/post/%d/-comment?limit=5' % post.id)
+                page1 = json.loads(rv.data)
+                self.assertEqual(len(page1['comments']), 5)
+                self.assertTrue(page1['has_next'])
+
+                rv = c.get('/post/%d/-comment?limit=5&after=%d' % (
+                    post.id, page1['next_after']
+                ))
+                page2 = json.loads(rv.data)
+                self.assertEqual(
+                    [comment['content'] for comment in page2['comments']],
+                    ['Comment 7', 'Comment 8', 'Comment 9']
+                )
+                self.assertFalse(page2['has_next'])
+
+                rv = c.get('/post/%d/-comment?format=ndjson' % post.id)
+                self.assertEqual(rv.mimetype, 'application/x-ndjson')
+                lines = rv.data.splitlines()
+                self.assertEqual(len(lines), 8)
+                self.assertFalse(
+                    any(json.loads(line)['is_spam'] for line in lines)
+                )
+
+                # The owner of the post gets all the comments
+                c.post('/login', data={
+                    'email': 'email@example.com',
+                    'password': 'password',
+                })
+                rv = c.get('/post/%d/-comment' % post.id)
+                self.assertEqual(len(json.loads(rv.data)['comments']), 10)
+
+            # Reading the serialized comments gives the same values as
+            # serializing the records
+            domain = [('post', '=', post.id)]
+            self.assertEqual(
+                self.BlogPostComment.search_serialized(domain),
+                [
+                    comment.serialize()
+                    for comment in self.BlogPostComment.search(domain)
+                ]
+            )
+
+    def test_0090_instrumentation(self):
+        "Instrumented routes report their timings when enabled"
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            self.BlogPost.create([{
+                'title': 'This is a blog post',
+                'uri': 'this-is-a-blog-post',
+                'content': 'Some test content',
+                'nereid_user': self.registered_user.id,
+                'state': 'Published',
+            }])
+            url = '/posts/%d' % self.registered_user.id
+
+            with app.test_client() as c:
+                rv = c.get(url)
+                self.assertFalse('Server-Timing' in rv.headers)
+
+                CONFIG.options['blog_instrumentation'] = 'True'
+                try:
+                    rv = c.get(url)
+                    self.assertEqual(rv.status_code, 200)
+                    self.assertEqual(rv.data, '1')
+                    self.assertTrue('sql;dur=' in rv.headers['Server-Timing'])
+
+                    # Statistics are not shown to guests
+                    rv = c.get('/posts/-stats')
+                    self.assertNotEqual(rv.status_code, 200)
+
+                    c.post('/login', data={
+                        'email': 'email@example.com',
+                        'password': 'password',
+                    })
+                    rv = c.get('/posts/-stats')
+                    stats = json.loads(rv.data)
+                    self.assertTrue(
+                        stats['routes']['render_list']['requests'] >= 1
+                    )
+                    self.assertTrue('render' in stats['caches'])
+                finally:
+                    del CONFIG.options['blog_instrumentation']
+
+                rv = c.get('/posts/-stats')
+                self.assertEqual(rv.status_code, 404)
+
+            # Nested counters leave the cursor as they found it
+            cursor = Transaction().cursor
+            with instrumentation.QueryCounter() as outer:
+                with instrumentation.QueryCounter() as inner:
+                    cursor.execute('SELECT 1')
+                cursor.execute('SELECT 1')
+            self.assertEqual((outer.count, inner.count), (2, 1))
+            self.assertFalse('execute' in vars(cursor))
+
+    def test_0100_excerpt(self):
+        "The excerpt, word count and reading time follow the content"
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            post, = self.BlogPost.create([{
+                'title': 'This is a blog post',
+                'uri': 'this-is-a-blog-post',
+                'content': 'Some test content',
+                'nereid_user': self.registered_user.id,
+                'state': 'Published',
+            }])
+            self.assertEqual(post.excerpt, 'Some test content')
+            self.assertEqual(post.word_count, 3)
+            self.assertEqual(post.reading_time, 1)
+
+            self.BlogPost.write([post], {'content': 'lorem ipsum ' * 250})
+            self.assertEqual(post.word_count, 500)
+            self.assertEqual(post.reading_time, 3)
+            self.assertTrue(post.excerpt.endswith('lorem...'))
+            self.assertTrue(len(post.excerpt) <= 203)
+
+            # A word starting past the excerpt length after blank content
+            self.BlogPost.write([post], {'content': ' ' * 200 + 'lorem'})
+            self.assertEqual(post.excerpt, '...')
+            self.assertEqual(post.word_count, 1)
+
+            self.assertEqual(
+                post.serialize('activity_stream')['content'], post.excerpt
+            )
+
+            with app.test_client() as c:
+                rv = c.get(
+                    '/posts/%d' % self.registered_user.id,
+                    headers=[('X-Requested-With', 'XMLHttpRequest')]
+                )
+                item, = json.loads(rv.data)['items']
+                self.assertEqual(item['excerpt'], post.excerpt)
+                self.assertFalse('content' in item)
+
+    def test_0110_comment_counters(self):
+        "Comment counters follow the comments and can be recomputed"
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            post, = self.BlogPost.create([{
+                'title': 'This is a blog post',
+                'uri': 'this-is-a-blog-post',
+                'content': 'Some test content',
+                'nereid_user': self.registered_user.id,
+                'state': 'Published',
+            }])
+            self.assertEqual(post.comment_count, 0)
+            self.assertEqual(post.published_comment_count, 0)
+
+            comments = self.BlogPostComment.create([{
+                'post': post.id,
+                'name': 'John Doe',
+                'content': 'Comment %d' % i,
+                'is_spam': i == 0,
+            } for i in range(3)])
+            self.assertEqual(post.comment_count, 3)
+            self.assertEqual(post.published_comment_count, 2)
+
+            self.BlogPostComment.write(comments[1:2], {'is_spam': True})
+            self.assertEqual(post.comment_count, 3)
+            self.assertEqual(post.published_comment_count, 1)
+
+            self.BlogPostComment.delete(comments[2:])
+            self.assertEqual(post.comment_count, 2)
+            self.assertEqual(post.published_comment_count, 0)
+
+            # Break the counters and repair them
+            self.BlogPost.update_comment_counts({post.id: (5, 5)})
+            self.assertEqual(post.comment_count, 7)
+            self.BlogPost.recompute_comment_counts([post])
+            self.assertEqual(post.comment_count, 2)
+            self.assertEqual(post.published_comment_count, 0)
+
+    def test_0120_content_html(self):
+        "The HTML of the content is rendered when the content is saved"
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            post, = self.BlogPost.create([{
+                'title': 'This is a blog post',
+                'uri': 'this-is-a-blog-post',
+                'content': 'Some <b>test</b> content\n\nSecond paragraph',
+                'nereid_user': self.registered_user.id,
+            }])
+            self.assertTrue('&lt;b&gt;' in post.content_html)
+            self.assertEqual(post.content_html.count('<p>'), 2)
+            self.assertEqual(
+                post.serialize()['content_html'], post.content_html
+            )
+
+            self.BlogPost.write([post], {'content': 'Edited'})
+            self.assertEqual(post.content_html, '<p>Edited</p>')
+
+            self.BlogPost.write([post], {'title': 'New title'})
+            self.assertEqual(post.content_html, '<p>Edited</p>')
+
+            self.BlogPost.rerender_content_html([post])
+            post = self.BlogPost(post.id)
+            self.assertEqual(post.content_html, '<p>Edited</p>')
+
+    def test_0130_search(self):
+        "Search the published posts"
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            post1, post2, draft = self.BlogPost.create([{
+                'title': 'Tryton modules',
+                'uri': 'tryton-modules',
+                'content': 'Writing modules for the Tryton framework',
+                'nereid_user': self.registered_user.id,
+                'state': 'Published',
+            }, {
+                'title': 'Nereid',
+                'uri': 'nereid',
+                'content': 'Web framework',
+                'nereid_user': self.registered_user.id,
+                'state': 'Published',
+            }, {
+                'title': 'Unpublished framework',
+                'uri': 'draft',
+                'content': 'Not yet',
+                'nereid_user': self.registered_user.id,
+            }])
+            headers = [('X-Requested-With', 'XMLHttpRequest')]
+
+            with app.test_client() as c:
+                rv = c.get('/posts/-search?q=framework', headers=headers)
+                self.assertEqual(
+                    set(item['id'] for item in json.loads(rv.data)['items']),
+                    set([post1.id, post2.id])
+                )
+
+                # Pages before the first one are the first one
+                rv = c.get('/posts/-search/0?q=framework', headers=headers)
+                self.assertEqual(len(json.loads(rv.data)['items']), 2)
+
+                rv = c.get('/posts/-search?q=tryton', headers=headers)
+                item, = json.loads(rv.data)['items']
+                self.assertEqual(item['id'], post1.id)
+
+                # Edits are searchable
+                self.BlogPost.write([post2], {'content': 'Web toolkit'})
+                rv = c.get('/posts/-search?q=framework', headers=headers)
+                item, = json.loads(rv.data)['items']
+                self.assertEqual(item['id'], post1.id)
+
+                rv = c.get('/posts/-search?q=')
+                self.assertEqual(rv.data, '0')
+
+    def test_0140_uri_cache(self):
+        "Posts are resolved from their uri through the uri cache"
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+            uri_cache.clear()
+
+            post, = self.BlogPost.create([{
+                'title': 'This is a blog post',
+                'uri': 'this-is-a-blog-post',
+                'content': 'Some test content',
+                'nereid_user': self.registered_user.id,
+            }])
+            url = '/post/%s/%s' % (
+                self.registered_user.id, 'this-is-a-blog-post'
+            )
+            user_id = self.registered_user.id
+
+            self.assertEqual(
+                self.BlogPost.resolve_uri(user_id, 'this-is-a-blog-post')[:2],
+                (post.id, 'Draft')
+            )
+            self.assertEqual(len(uri_cache), 1)
+            self.assertEqual(
+                self.BlogPost.resolve_uri(user_id, 'no-such-post'), None
+            )
+            self.assertEqual(len(uri_cache), 1)
+
+            with app.test_client() as c:
+                rv = c.get(url)
+                self.assertEqual(rv.status_code, 403)
+
+                # The state change drops the cached resolution
+                self.BlogPost.publish([post])
+                self.assertEqual(len(uri_cache), 0)
+                rv = c.get(url)
+                self.assertEqual(rv.status_code, 200)
+
+                # So does a change of uri
+                self.BlogPost.write([post], {'uri': 'a-new-uri'})
+                rv = c.get(url)
+                self.assertEqual(rv.status_code, 404)
+                rv = c.get('/post/%s/a-new-uri' % user_id)
+                self.assertEqual(rv.status_code, 200)
+
+                self.BlogPost.delete([post])
+                rv = c.get('/post/%s/a-new-uri' % user_id)
+                self.assertEqual(rv.status_code, 404)
+
+    def test_0150_invalidation_bus(self):
+        "Cache invalidations are propagated to the other processes"
+        fd, path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        CONFIG.options['blog_invalidation_bus'] = 'sqlite://' + path
+        invalidation._bus = None
+        try:
+            with Transaction().start(DB_NAME, USER, CONTEXT):
+                self.setup_defaults()
+                dbname = Transaction().cursor.database_name
+
+                post, = self.BlogPost.create([{
+                    'title': 'This is a blog post',
+                    'uri': 'this-is-a-blog-post',
+                    'content': 'Some test content',
+                    'nereid_user': self.registered_user.id,
+                }])
+                tag = ('blog.post', dbname, post.id)
+
+                # Another process listening on the same bus
+                other = invalidation.SQLiteBus(path)
+                self.BlogPost.write([post], {'title': 'A new title'})
+                # Published once the transaction is committed
+                self.assertEqual(other.poll(), [])
+                invalidation.flush()
+                self.assertTrue(tag in other.poll())
+                self.assertEqual(other.poll(), [])
+
+                # Invalidations of the other processes are consumed before
+                # reading the caches, but not the own ones
+                uri_cache.set('key', 'value', tags=[tag])
+                invalidation.get_bus().publish([tag])
+                invalidation.consume()
+                self.assertEqual(uri_cache.get('key'), 'value')
+
+                other.publish([tag])
+                self.BlogPost.resolve_uri(
+                    self.registered_user.id, 'this-is-a-blog-post'
+                )
+                self.assertEqual(uri_cache.get('key'), None)
+
+                uri_cache.set('key', 'value')
+                other.publish([invalidation.CLEAR])
+                invalidation.consume()
+                self.assertEqual(len(uri_cache), 0)
+        finally:
+            del CONFIG.options['blog_invalidation_bus']
+            invalidation._bus = None
+            os.remove(path)
+
+    def test_0160_conditional_requests(self):
+        "Posts, lists and comments answer conditional requests with a 304"
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            post, = self.BlogPost.create([{
+                'title': 'This is a blog post',
+                'uri': 'this-is-a-blog-post',
+                'content': 'Some test content',
+                'nereid_user': self.registered_user.id,
+                'allow_guest_comments': True,
+                'state': 'Published',
+            }])
+            urls = [
+                '/post/%s/this-is-a-blog-post' % self.registered_user.id,
+                '/posts/%s' % self.registered_user.id,
+                '/post/%s/-comment' % post.id,
+            ]
+
+            with app.test_client() as c:
+                # Pages rendered from templates carry the validators
+                rv = c.get(urls[0])
+                self.assertEqual(rv.status_code, 200)
+                self.assertTrue('Some test content' in rv.data)
+                rv = c.get(urls[0], headers=[
+                    ('If-None-Match', rv.headers['ETag'])
+                ])
+                self.assertEqual(rv.status_code, 304)
+                rv = c.get(urls[1])
+                self.assertEqual(rv.status_code, 200)
+                self.assertEqual(rv.data, '1')
+                rv = c.get(urls[1], headers=[
+                    ('If-None-Match', rv.headers['ETag'])
+                ])
+                self.assertEqual(rv.status_code, 304)
+
+                for url in urls:
+                    rv = c.get(url)
+                    self.assertEqual(rv.status_code, 200)
+                    etag = rv.headers['ETag']
+                    last_modified = rv.headers['Last-Modified']
+
+                    rv = c.get(url, headers=[('If-None-Match', etag)])
+                    self.assertEqual(rv.status_code, 304)
+                    self.assertEqual(rv.data, '')
+                    self.assertEqual(rv.headers['ETag'], etag)
+
+                    rv = c.get(url, headers=[('If-None-Match', '"stale"')])
+                    self.assertEqual(rv.status_code, 200)
+
+                    rv = c.get(url, headers=[
+                        ('If-Modified-Since', last_modified)
+                    ])
+                    self.assertEqual(rv.status_code, 304)
+
+                # A new comment changes the entity tag of the comments
+                rv = c.get(urls[2])
+                etag = rv.headers['ETag']
+                c.post(urls[2], data={
+                    'name': 'John Doe',
+                    'content': 'This is an awesome post',
+                })
+                rv = c.get(urls[2], headers=[('If-None-Match', etag)])
+                self.assertEqual(rv.status_code, 200)
+                self.assertEqual(len(json.loads(rv.data)['comments']), 1)
+
+                # The timestamp of the list is cached until a post changes
+                rv = c.get(urls[1])
+                etag = rv.headers['ETag']
+                self.assertEqual(len(list_cache), 1)
+                self.BlogPost.create([{
+                    'title': 'Another blog post',
+                    'uri': 'another-blog-post',
+                    'content': 'Some test content',
+                    'nereid_user': self.registered_user.id,
+                }])
+                self.assertEqual(len(list_cache), 0)
+                rv = c.get(urls[1], headers=[('If-None-Match', etag)])
+                self.assertEqual(rv.status_code, 200)
+
+                # Errors carry no validators
+                rv = c.get('/post/%s/no-such-post' % self.registered_user.id)
+                self.assertEqual(rv.status_code, 404)
+                self.assertFalse('ETag' in rv.headers)
+
+    def test_0170_feeds(self):
+        "Atom feeds of the published posts are cached until they change"
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+            feed_cache.clear()
+
+            post1, post2 = self.BlogPost.create([{
+                'title': 'Published post',
+                'uri': 'published-post',
+                'content': 'Some test content',
+                'nereid_user': self.registered_user.id,
+                'state': 'Published',
+            }, {
+                'title': 'Draft post',
+                'uri': 'draft-post',
+                'content': 'Some test content',
+                'nereid_user': self.registered_user.id,
+            }])
+            url = '/posts/%s/feed.atom' % self.registered_user.id
+
+            with app.test_client() as c:
+                rv = c.get(url)
+                self.assertEqual(rv.status_code, 200)
+                self.assertEqual(rv.mimetype, 'application/atom+xml')
+                self.assertTrue('Published post' in rv.data)
+                self.assertFalse('Draft post' in rv.data)
+                self.assertEqual(len(feed_cache), 1)
+
+                rv = c.get(url, headers=[
+                    ('If-None-Match', rv.headers['ETag'])
+                ])
+                self.assertEqual(rv.status_code, 304)
+
+                rv = c.get('/posts/feed.atom')
+                self.assertTrue('Published post' in rv.data)
+                self.assertEqual(len(feed_cache), 2)
+
+                # Comments leave the feeds alone
+                self.BlogPostComment.create([{
+                    'post': post1.id,
+                    'name': 'John Doe',
+                    'content': 'This is an awesome post',
+                }])
+                self.assertEqual(len(feed_cache), 2)
+
+                # Publishing a post regenerates the feeds
+                self.BlogPost.publish([post2])
+                self.assertEqual(len(feed_cache), 0)
+                rv = c.get(url)
+                self.assertTrue('Draft post' in rv.data)
+
+                self.BlogPost.archive([post1])
+                rv = c.get('/posts/feed.atom')
+                self.assertFalse('Published post' in rv.data)
+
+    def test_0180_bulk_change_state(self):
+        "Change the state of many posts at once"
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            posts = self.BlogPost.create([{
+                'title': 'Post %d' % i,
+                'uri': 'post-%d' % i,
+                'content': 'Some test content',
+                'nereid_user': self.registered_user.id,
+            } for i in range(5)])
+            other, = self.BlogPost.create([{
+                'title': 'Post of another user',
+                'uri': 'post-of-another-user',
+                'content': 'Some test content',
+                'nereid_user': self.registered_user2.id,
+            }])
+            self.BlogPost.archive(posts[:1])
+
+            results = self.BlogPost.bulk_change_state(
+                [p.id for p in posts[:3]], 'publish', chunk_size=1
+            )
+            self.assertEqual(
+                [(r['id'], r['success'], r['error']) for r in results], [
+                    (posts[0].id, False, 'invalid_transition'),
+                    (posts[1].id, True, None),
+                    (posts[2].id, True, None),
+                ]
+            )
+            # Published in the same batch, at the same date
+            post1, post2 = self.BlogPost.browse([posts[1].id, posts[2].id])
+            self.assertEqual(post1.state, 'Published')
+            self.assertEqual(post1.post_date, post2.post_date)
+
+            with app.test_client() as c:
+                c.post('/login', data={
+                    'email': 'email@example.com',
+                    'password': 'password',
+                })
+                rv = c.post('/posts/-change-state', data={
+                    'state': 'archive',
+                    'ids': '%d,%d,%d' % (posts[1].id, posts[0].id, other.id),
+                }, headers=[('X-Requested-With', 'XMLHttpRequest')])
+                data = json.loads(rv.data)
+                self.assertFalse(data['success'])
+                self.assertEqual(
+                    [r['error'] for r in data['results']],
+                    [None, 'invalid_transition', 'not_found']
+                )
+                self.assertEqual(
+                    self.BlogPost(posts[1].id).state, 'Archived'
+                )
+                self.assertEqual(self.BlogPost(other.id).state, 'Draft')
+
+                rv = c.post('/posts/-change-state', data={
+                    'state': 'delete', 'ids': str(posts[4].id),
+                })
+                self.assertEqual(rv.status_code, 400)
+
+    def test_0190_scheduled_publish(self):
+        "Drafts are published by the scheduler once their date is past"
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            due1, due2, later, unscheduled = self.BlogPost.create([{
+                'title': 'Post %d' % i,
+                'uri': 'post-%d' % i,
+                'content': 'Some test content',
+                'nereid_user': self.registered_user.id,
+                'scheduled_publish_date': date,
+            } for i, date in enumerate([
+                datetime(2014, 1, 1), datetime(2014, 1, 2),
+                datetime(2100, 1, 1), None,
+            ])])
+
+            self.BlogPost.publish_scheduled(batch_size=1)
+            due1, due2, later, unscheduled = self.BlogPost.browse(
+                [due1.id, due2.id, later.id, unscheduled.id]
+            )
+            self.assertEqual(due1.state, 'Published')
+            self.assertEqual(due2.state, 'Published')
+            self.assertTrue(due1.post_date)
+            self.assertEqual(due1.scheduled_publish_date, None)
+            self.assertEqual(later.state, 'Draft')
+            self.assertEqual(unscheduled.state, 'Draft')
+
+            # Drafts published again by hand are not scheduled anymore
+            self.BlogPost.draft([due1])
+            self.BlogPost.publish_scheduled()
+            self.assertEqual(self.BlogPost(due1.id).state, 'Draft')
+
+    def test_0200_comment_queue(self):
+        "Comments are queued and inserted in batches when the queue is on"
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+            CommentQueue = POOL.get('blog.post.comment.queue')
+
+            post, = self.BlogPost.create([{
+                'title': 'This is a blog post',
+                'uri': 'this-is-a-blog-post',
+                'content': 'Some test content',
+                'nereid_user': self.registered_user.id,
+                'allow_guest_comments': True,
+                'state': 'Published',
+            }])
+
+            CONFIG.options['blog_comment_queue'] = 'True'
+            try:
+                with app.test_client() as c:
+                    for i in range(3):
+                        rv = c.post('/post/%d/-comment' % post.id, data={
+                            'name': 'John Doe',
+                            'content': 'Comment %d' % i,
+                        }, headers=[('X-Requested-With', 'XMLHttpRequest')])
+                        self.assertEqual(rv.status_code, 202)
+            finally:
+                del CONFIG.options['blog_comment_queue']
+
+            self.assertEqual(CommentQueue.search([], count=True), 3)
+            self.assertEqual(self.BlogPost(post.id).comment_count, 0)
+            # Comments posted a while before the queue is processed
+            queue = CommentQueue.__table__()
+            posted = datetime(2014, 1, 1, 12, 0, 0)
+            Transaction().cursor.execute(*queue.update(
+                [queue.create_date], [posted]
+            ))
+
+            CommentQueue.process(batch_size=2)
+            self.assertEqual(CommentQueue.search([], count=True), 0)
+            post = self.BlogPost(post.id)
+            self.assertEqual(post.comment_count, 3)
+            self.assertEqual(
+                sorted(c.content for c in post.comments),
+                ['Comment 0', 'Comment 1', 'Comment 2']
+            )
+            # The comments are dated when they were posted
+            self.assertEqual(
+                set(c.create_date for c in post.comments), set([posted])
+            )
+
+    def test_0210_latest_posts(self):
+        "The latest published posts of all the users, with a cursor"
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            posts = self.BlogPost.create([{
+                'title': 'Post %d' % i,
+                'uri': 'post-%d' % i,
+                'content': 'Some test content',
+                'nereid_user': user.id,
+                'state': 'Published',
+                'post_date': datetime(2014, 1, 1, i),
+            } for i, user in enumerate(
+                [self.registered_user, self.registered_user2] * 6
+            )])
+            self.BlogPost.archive(posts[-1:])
+
+            headers = [('X-Requested-With', 'XMLHttpRequest')]
+            with app.test_client() as c:
+                rv = c.get('/posts/-latest')
+                self.assertEqual(rv.data, '10')
+
+                ids = []
+                after = ''
+                while after is not None:
+                    rv = c.get(
+                        '/posts/-latest?after=%s' % after, headers=headers
+                    )
+                    data = json.loads(rv.data)
+                    ids.extend(item['id'] for item in data['items'])
+                    after = data['next_cursor']
+                self.assertEqual(ids, [p.id for p in reversed(posts[:-1])])
+
+    def test_0220_rate_limits(self):
+        "Comments and posts beyond the rate limits are rejected"
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            post, = self.BlogPost.create([{
+                'title': 'This is a blog post',
+                'uri': 'this-is-a-blog-post',
+                'content': 'Some test content',
+                'nereid_user': self.registered_user.id,
+                'allow_guest_comments': True,
+                'state': 'Published',
+            }])
+            headers = [('X-Requested-With', 'XMLHttpRequest')]
+
+            CONFIG.options['blog_rate_limit_comment'] = '2/3600'
+            CONFIG.options['blog_rate_limit_post'] = '1/3600'
+            ratelimit._storage = None
+            try:
+                with app.test_client() as c:
+                    for i in range(3):
+                        rv = c.post('/post/%d/-comment' % post.id, data={
+                            'name': 'John Doe',
+                            'content': 'Comment %d' % i,
+                        }, headers=headers)
+                    self.assertEqual(rv.status_code, 429)
+                    self.assertTrue(int(rv.headers['Retry-After']) > 0)
+                    self.assertEqual(
+                        self.BlogPost(post.id).comment_count, 2
+                    )
+
+                    # Reading is not limited
+                    rv = c.get('/post/%d/-comment' % post.id)
+                    self.assertEqual(rv.status_code, 200)
+
+                    # Logged in users have their own buckets
+                    c.post('/login', data={
+                        'email': 'email@example.com',
+                        'password': 'password',
+                    })
+                    rv = c.post('/post/%d/-comment' % post.id, data={
+                        'content': 'Comment of a user',
+                    }, headers=headers)
+                    self.assertEqual(rv.status_code, 200)
+
+                    for i in range(2):
+                        rv = c.post('/post/-new', data={
+                            'title': 'New post %d' % i,
+                            'content': 'Some test content',
+                        }, headers=headers)
+                    self.assertEqual(rv.status_code, 429)
+                    self.assertEqual(len(self.BlogPost.search([])), 2)
+
+                self.assertEqual(ratelimit.stats()['comment']['limited'], 1)
+                self.assertEqual(ratelimit.stats()['post']['limited'], 1)
+            finally:
+                del CONFIG.options['blog_rate_limit_comment']
+                del CONFIG.options['blog_rate_limit_post']
+                ratelimit._storage = None
+
+    def test_0230_spam_classifier(self):
+        "Comments are flagged as spam by the classifier once it is trained"
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            post, = self.BlogPost.create([{
+                'title': 'This is a blog post',
+                'uri': 'this-is-a-blog-post',
+                'content': 'Some test content',
+                'nereid_user': self.registered_user.id,
+                'allow_guest_comments': True,
+                'state': 'Published',
+            }])
+            spammy = 'Cheap pills online, buy viagra now at discount prices'
+            earlier, = self.BlogPostComment.create([{
+                'post': post.id,
+                'name': 'Spammer',
+                'content': spammy,
+            }])
+            # Not trained yet
+            self.assertFalse(earlier.is_spam)
+
+            spam.train([
+                ('Buy cheap pills %d online now' % i, 'Spammer')
+                for i in range(9)
+            ], True)
+            spam.train([
+                ('Great post, thanks for explaining %d' % i, 'John Doe')
+                for i in range(10)
+            ], False)
+            self.assertEqual(spam.classify(spammy, 'Spammer'), None)
+
+            with app.test_client() as c:
+                c.post('/login', data={
+                    'email': 'email@example.com',
+                    'password': 'password',
+                })
+                # The decisions of the owner train the classifier
+                rv = c.post('/comment/%s/-spam' % earlier.id, data={
+                    'spam': True
+                }, headers=[('X-Requested-With', 'XMLHttpRequest')])
+                self.assertEqual(rv.status_code, 200)
+
+            self.assertTrue(spam.classify(spammy, 'Spammer'))
+            spammer, author = self.BlogPostComment.create([{
+                'post': post.id,
+                'name': 'Spammer',
+                'content': 'Buy cheap pills online',
+            }, {
+                'post': post.id,
+                'name': 'John Doe',
+                'content': 'Great post, thanks for explaining',
+            }])
+            self.assertTrue(spammer.is_spam)
+            self.assertFalse(author.is_spam)
+            post = self.BlogPost(post.id)
+            self.assertEqual(post.comment_count, 3)
+            self.assertEqual(post.published_comment_count, 1)
+
+            # Comments created before the training are rescored in batch
+            before, = self.BlogPostComment.create([{
+                'post': post.id,
+                'name': 'Spammer',
+                'content': spammy,
+                'is_spam': False,
+            }])
+            self.BlogPostComment.rescore_spam(chunk_size=1)
+            self.assertTrue(self.BlogPostComment(before.id).is_spam)
+            self.assertFalse(self.BlogPostComment(author.id).is_spam)
+
+            SpamToken = POOL.get('blog.spam.token')
+            with app.test_client() as c:
+                c.post('/login', data={
+                    'email': 'email@example.com',
+                    'password': 'password',
+                })
+                # Only a change of the flag trains the classifier
+                c.post('/comment/%s/-spam' % earlier.id, data={
+                    'spam': True
+                }, headers=[('X-Requested-With', 'XMLHttpRequest')])
+                self.assertEqual(SpamToken.load()[spam.DOCUMENTS], (10, 10))
+
+                # A correction moves the comment to the other kind
+                c.post('/comment/%s/-spam' % earlier.id, data={
+                    'spam': ''
+                }, headers=[('X-Requested-With', 'XMLHttpRequest')])
+                self.assertEqual(SpamToken.load()[spam.DOCUMENTS], (9, 11))
+                self.assertEqual(
+                    spam.get_classifier().spam_documents, 9
+                )
+
+            # The decision of the owner stands
+            self.BlogPostComment.rescore_spam()
+            self.assertFalse(self.BlogPostComment(earlier.id).is_spam)
+
+    def test_0240_bulk_manage_spam(self):
+        "Mark many comments as spam at once"
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            post, = self.BlogPost.create([{
+                'title': 'This is a blog post',
+                'uri': 'this-is-a-blog-post',
+                'content': 'Some test content',
+                'nereid_user': self.registered_user.id,
+                'allow_guest_comments': True,
+                'state': 'Published',
+            }])
+            other_post, = self.BlogPost.create([{
+                'title': 'Post of another user',
+                'uri': 'post-of-another-user',
+                'content': 'Some test content',
+                'nereid_user': self.registered_user2.id,
+                'allow_guest_comments': True,
+                'state': 'Published',
+            }])
+            comments = self.BlogPostComment.create([{
+                'post': post_id,
+                'name': name,
+                'content': 'Comment %d' % i,
+                'ip_address': ip_address,
+            } for i, (post_id, name, ip_address) in enumerate([
+                (post.id, 'Spammer', '10.0.0.1'),
+                (post.id, 'Spammer', '10.0.0.2'),
+                (post.id, 'John Doe', '10.0.0.1'),
+                (post.id, 'John Doe', '10.0.0.3'),
+                (other_post.id, 'Spammer', '10.0.0.1'),
+            ])])
+            headers = [('X-Requested-With', 'XMLHttpRequest')]
+
+            with app.test_client() as c:
+                c.post('/login', data={
+                    'email': 'email@example.com',
+                    'password': 'password',
+                })
+                rv = c.post('/comments/-spam', data={}, headers=headers)
+                self.assertEqual(rv.status_code, 400)
+
+                # Comments of the posts of other users are left alone
+                rv = c.post('/comments/-spam', data={
+                    'ip_address': '10.0.0.1',
+                }, headers=headers)
+                self.assertEqual(
+                    sorted(json.loads(rv.data)['ids']),
+                    [comments[0].id, comments[2].id]
+                )
+                rv = c.post('/comments/-spam', data={
+                    'name': 'Spammer',
+                    'ids': '%d,%d' % (comments[1].id, comments[4].id),
+                }, headers=headers)
+                self.assertEqual(json.loads(rv.data)['ids'], [comments[1].id])
+
+                post = self.BlogPost(post.id)
+                self.assertEqual(post.comment_count, 4)
+                self.assertEqual(post.published_comment_count, 1)
+                self.assertEqual(
+                    self.BlogPost(other_post.id).published_comment_count, 1
+                )
+                # The classifier is trained with all of them at once
+                self.assertEqual(
+                    POOL.get('blog.spam.token').load()[spam.DOCUMENTS], (3, 0)
+                )
+
+                rv = c.post('/comments/-spam', data={
+                    'spam': 'false',
+                    'name': 'John Doe',
+                }, headers=headers)
+                self.assertEqual(json.loads(rv.data)['ids'], [comments[2].id])
+                post = self.BlogPost(post.id)
+                self.assertEqual(post.published_comment_count, 2)
+                self.assertEqual(
+                    POOL.get('blog.spam.token').load()[spam.DOCUMENTS], (2, 1)
+                )
+
+                # Comments posted on the site record their address
+                c.post('/post/%d/-comment' % post.id, data={
+                    'content': 'Comment of a user',
+                }, environ_base={'REMOTE_ADDR': '10.0.0.9'})
+                comment, = self.BlogPostComment.search([
+                    ('content', '=', 'Comment of a user'),
+                ])
+                self.assertEqual(comment.ip_address, '10.0.0.9')
 
 
 def suite():